@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+    Benchmarks of kicad_netlist_reader on synthetic netlists.
+
+    Usage: bench_netlist.py [components]
+
+    The component filter is always measured on 10000 components.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+
+import kicad_netlist_reader
+
+VALUES = ['10k', '4.7k', '1k', '100n', '1u', '22p', 'LED', 'STM32F103']
+FOOTPRINTS = ['Resistor_SMD:R_0603', 'Capacitor_SMD:C_0603', 'Capacitor_SMD:C_0805',
+              'LED_SMD:LED_0603', 'Package_QFP:LQFP-48']
+PREFIXES = ['R', 'C', 'D', 'U', 'TP']
+
+
+def writeNetlist(f, components, seed=0):
+    """Write a KiCad 6 like generic netlist with the given number of
+    components, about 12 nodes per component.  Every tenth component has no
+    libsource description"""
+    rand = random.Random(seed)
+    libparts = max(1, components // 50)
+    refs = []
+
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<export version="E">\n')
+    f.write('  <design>\n    <source>bench.kicad_sch</source>\n'
+            '    <date>2022-01-01</date>\n    <tool>Eeschema 6.0</tool>\n  </design>\n')
+
+    f.write('  <components>\n')
+    for i in range(components):
+        ref = rand.choice(PREFIXES) + str(i + 1)
+        refs.append(ref)
+        part = rand.randrange(libparts)
+        f.write('    <comp ref="%s">\n' % ref)
+        f.write('      <value>%s</value>\n' % rand.choice(VALUES))
+        f.write('      <footprint>%s</footprint>\n' % rand.choice(FOOTPRINTS))
+        f.write('      <fields>\n')
+        f.write('        <field name="Rating">50V</field>\n')
+        f.write('        <field name="Distributor">Mouser</field>\n')
+        if rand.random() < 0.05:
+            f.write('        <field name="Installed">NU</field>\n')
+        f.write('      </fields>\n')
+        if i % 10 == 0:
+            # description is optional, older netlists leave it out
+            f.write('      <libsource lib="Device" part="P%d"/>\n' % part)
+        else:
+            f.write('      <libsource lib="Device" part="P%d" description="Part %d"/>\n'
+                    % (part, part))
+        f.write('      <sheetpath names="/" tstamps="/"/>\n')
+        f.write('      <tstamps>%08x</tstamps>\n' % i)
+        f.write('    </comp>\n')
+    f.write('  </components>\n')
+
+    f.write('  <libparts>\n')
+    for part in range(libparts):
+        f.write('    <libpart lib="Device" part="P%d">\n' % part)
+        f.write('      <description>Part %d</description>\n' % part)
+        f.write('      <fields>\n        <field name="Reference">X</field>\n'
+                '        <field name="Value">P%d</field>\n      </fields>\n' % part)
+        f.write('      <pins>\n        <pin num="1" name="A" type="passive"/>\n'
+                '        <pin num="2" name="B" type="passive"/>\n      </pins>\n')
+        f.write('    </libpart>\n')
+    f.write('  </libparts>\n')
+
+    f.write('  <libraries>\n    <library logical="Device">\n'
+            '      <uri>Device.kicad_sym</uri>\n    </library>\n  </libraries>\n')
+
+    f.write('  <nets>\n')
+    for net in range(components):
+        f.write('    <net code="%d" name="Net-%d">\n' % (net + 1, net))
+        for pin in (1, 2):
+            f.write('      <node ref="%s" pin="%d" pintype="passive"/>\n'
+                    % (rand.choice(refs), pin))
+        f.write('    </net>\n')
+    f.write('  </nets>\n</export>\n')
+
+
+def countNodes(element):
+    count = 0
+    pending = [element]
+    while pending:
+        element = pending.pop()
+        count += 1
+        pending.extend(element.children)
+    return count
+
+
+def benchParse(fname, repeat=3):
+    for backend in sorted(kicad_netlist_reader.loaders):
+        if backend == 'lxml' and kicad_netlist_reader.lxml_etree is None:
+            print('parse: %-6s not installed' % backend)
+            continue
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            kicad_netlist_reader.netlist(fname, backend)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('parse: %-6s %.3fs' % (backend, best))
+
+
+def benchMemory(fname, sections=None):
+    tracemalloc.start()
+    start = time.perf_counter()
+    net = kicad_netlist_reader.netlist(fname, sections=sections)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('memory: %-21s %d nodes, loaded in %.2fs, %.1f MB held, %.1f MB peak' %
+          (','.join(sorted(sections)) if sections else 'all', countNodes(net.tree),
+           elapsed, current / 1e6, peak / 1e6))
+
+
+def benchFilter(components=10000, repeat=5):
+    """Select the BOM components of a design with exclusions configured"""
+    kicad_netlist_reader.excluded_references = ['TP[0-9]+', 'MH[0-9]+', 'FID[0-9]+']
+    kicad_netlist_reader.excluded_values = ['MOUNTHOLE', 'SCOPETEST', 'SOLDER_BRIDGE.*']
+    kicad_netlist_reader.excluded_footprints = ['MountingHole:.*', 'Fiducial:.*']
+
+    fd, fname = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            writeNetlist(f, components)
+        net = kicad_netlist_reader.netlist(fname, sections={'components', 'libparts'})
+    finally:
+        os.remove(fname)
+
+    componentFilter = kicad_netlist_reader.ComponentFilter()
+    for name, selected in (('default', lambda: net.getInterestingComponents()),
+                           ('reused', lambda: net.getInterestingComponents(componentFilter)),
+                           ('grouped', lambda: net.groupComponents(componentFilter=componentFilter))):
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            count = len(selected())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('filter: %-8s %d components, %d results in %.3fs' %
+              (name, components, count, best))
+
+
+if __name__ == '__main__':
+    components = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+
+    # measure parsing, not the cache
+    kicad_netlist_reader.netlist_cache = False
+
+    fd, fname = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            writeNetlist(f, components)
+        print('netlist: %d components, %.1f MB' %
+              (components, os.path.getsize(fname) / 1e6))
+
+        benchParse(fname)
+        benchMemory(fname)
+        benchMemory(fname, {'components', 'libparts'})
+    finally:
+        os.remove(fname)
+
+    benchFilter()
@@ -19,9 +19,24 @@
 from __future__ import print_function
 import sys
 import xml.sax as sax
+from xml.sax.saxutils import escape
+import xml.parsers.expat as expat
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+from functools import lru_cache, wraps
 import re
 import pdb
 import string
+import io
+import os
+import pickle
+import hashlib
+import tempfile
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 
 #-----<Configure>----------------------------------------------------------------
 
@@ -39,7 +54,8 @@ excluded_fields = [
 # You may exclude components from the BOM by either:
 #
 # 1) adding a custom field named "Installed" to your components and filling it
-# with a value of "NU" (Normally Uninstalled).
+# with a value of "NU" (Normally Uninstalled), or any other field and value
+# of dnp_fields below.
 # See netlist.getInterestingComponents(), or
 #
 # 2) blacklisting it in any of the three following lists:
@@ -68,16 +84,65 @@ excluded_footprints = [
     #'MOUNTHOLE'
     ]
 
+
+# component fields marking components as not populated, with the values doing
+# so.  Components with one of these fields set to one of its values are
+# excluded from the BOM.
+dnp_fields = {
+    'Installed': ['NU'],
+    # 'DNP': ['DNP', 'Yes'],
+    }
+
+
+# The parser used to load netlists, one of the keys of 'loaders' below:
+# 'sax', 'expat', 'etree' or 'lxml'.  None picks 'lxml' when it is installed
+# and 'expat' otherwise.
+netlist_backend = None
+
+
+# Loaded netlists are cached on disk, keyed by the content of the netlist file,
+# so that loading an unchanged netlist again skips parsing.  The cache lives in
+# netlist_cache_dir, or in $XDG_CACHE_HOME/kirelease/netlists if None, and the
+# least recently used entries are evicted above netlist_cache_max_bytes.
+netlist_cache = True
+netlist_cache_dir = None
+netlist_cache_max_bytes = 256 * 1024 * 1024
+
 #-----</Configure>---------------------------------------------------------------
 
 
+# Called with the name of a hot step of the reader (parsing, linking, indexing,
+# grouping...) to return a context manager timing it, e.g. utils.trace_span.
+# None leaves the reader uninstrumented.
+tracer = None
+
+
+def _traced(name):
+    """Decorator timing every call of the function through tracer"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class xmlElement():
     """xml element which can represent all nodes of the netlist tree.  It can be
     used to easily generate various output formats by propagating format
     requests to children recursively.
+
+    Netlists hold a lot of these, so they have no instance dictionary and
+    their tag and attribute names are interned.  Once a netlist is loaded its
+    tree is frozen, children are then held in tuples (see freeze()).
     """
+    __slots__ = ('name', 'attributes', 'parent', 'chars', 'children')
+
     def __init__(self, name, parent=None):
-        self.name = name
+        self.name = sys.intern(name)
         self.attributes = {}
         self.parent = parent
         self.chars = ""
@@ -90,54 +155,76 @@ class xmlElement():
         return self.name + "[" + self.chars + "]" + " attr_count:" + str(len(self.attributes))
 
     def formatXML(self, nestLevel=0, amChild=False):
-        """Return this element formatted as XML
+        """Return this element formatted as XML, see writeXML()"""
+        f = io.StringIO()
+        self.writeXML(f, nestLevel, amChild)
+        return f.getvalue()
+
+    def writeXML(self, f, nestLevel=0, amChild=False):
+        """Write this element formatted as XML to the file-like object f
 
         Keywords:
         nestLevel -- increases by one for each level of nesting.
-        amChild -- If set to True, the start of document is not returned.
+        amChild -- If set to True, the start of document is not written.
 
         """
-        s = ""
-
-        indent = ""
-        for i in range(nestLevel):
-            indent += "    "
+        out = []
+        write = out.append
 
         if not amChild:
-            s = "<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
-
-        s += indent + "<" + self.name
-        for a in self.attributes:
-            s += " " + a + "=\"" + self.attributes[a] + "\""
-
-        if (len(self.chars) == 0) and (len(self.children) == 0):
-            s += "/>"
-        else:
-            s += ">" + self.chars
-
-        for c in self.children:
-            s += "\n"
-            s += c.formatXML(nestLevel+1, True)
-
-        if (len(self.children) > 0):
-            s += "\n" + indent
+            write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
+
+        # the tree is walked with a stack rather than recursively, it holds
+        # the elements to write and the text closing the elements written
+        pending = [(self, nestLevel)]
+        while pending:
+            item = pending.pop()
+            if type(item) is str:
+                write(item)
+                continue
+
+            element, level = item
+            indent = _indent(level)
+            write(indent + "<" + element.name)
+            for a in element.attributes:
+                write(" " + a + "=\"" + _escapeAttribute(element.attributes[a]) + "\"")
+
+            if not element.chars and not element.children:
+                write("/>")
+            else:
+                write(">" + _escape(element.chars))
+                if element.children:
+                    pending.append("\n" + indent + "</" + element.name + ">")
+                else:
+                    pending.append("</" + element.name + ">")
+                for c in reversed(element.children):
+                    pending.append((c, level + 1))
+                    pending.append("\n")
 
-        if (len(self.children) > 0) or (len(self.chars) > 0):
-            s += "</" + self.name + ">"
+            if len(out) >= _WRITE_PARTS:
+                f.write("".join(out))
+                del out[:]
 
-        return s
+        f.write("".join(out))
 
     def formatHTML(self, amChild=False):
-        """Return this element formatted as HTML
+        """Return this element formatted as HTML, see writeHTML()"""
+        f = io.StringIO()
+        self.writeHTML(f, amChild)
+        return f.getvalue()
+
+    def writeHTML(self, f, amChild=False):
+        """Write this element formatted as HTML to the file-like object f
 
         Keywords:
-        amChild -- If set to True, the start of document is not returned
+        amChild -- If set to True, the start of document is not written
 
         """
-        s = ""
+        out = []
+        write = out.append
 
         if not amChild:
-            s = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+            write("""<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
                 "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
                 <html xmlns="http://www.w3.org/1999/xhtml">
                 <head>
@@ -146,35 +233,40 @@ class xmlElement():
                 </head>
                 <body>
                 <table>
-                """
-
-        s += "<tr><td><b>" + self.name + "</b><br>" + self.chars + "</td><td><ul>"
-        for a in self.attributes:
-            s += "<li>" + a + " = " + self.attributes[a] + "</li>"
-
-        s += "</ul></td></tr>\n"
-
-        for c in self.children:
-            s += c.formatHTML(True)
+                """)
+
+        # one row per element, in document order
+        pending = [self]
+        while pending:
+            element = pending.pop()
+            write("<tr><td><b>" + element.name + "</b><br>" + _escape(element.chars) + "</td><td><ul>")
+            for a in element.attributes:
+                write("<li>" + a + " = " + _escape(element.attributes[a]) + "</li>")
+            write("</ul></td></tr>\n")
+            pending.extend(reversed(element.children))
+
+            if len(out) >= _WRITE_PARTS:
+                f.write("".join(out))
+                del out[:]
 
         if not amChild:
-            s += """</table>
+            write("""</table>
                 </body>
-                </html>"""
+                </html>""")
 
-        return s
+        f.write("".join(out))
 
     def addAttribute(self, attr, value):
         """Add an attribute to this element"""
         if type(value) != str: value = value.encode('utf-8')
-        self.attributes[attr] = value
+        self.attributes[sys.intern(attr)] = value
 
     def setAttribute(self, attr, value):
         """Set an attributes value - in fact does the same thing as add
         attribute
 
         """
-        self.attributes[attr] = value
+        self.attributes[sys.intern(attr)] = value
 
     def setChars(self, chars):
         """Set the characters for this element"""
@@ -186,9 +278,32 @@ class xmlElement():
 
     def addChild(self, child):
         """Add a child element to this element"""
+        if type(self.children) is tuple:
+            self.children = list(self.children)
         self.children.append(child)
         return self.children[len(self.children) - 1]
 
+    @_traced('netlist.freeze')
+    def freeze(self):
+        """Store the children of this element and of all its descendants in
+        tuples, which are smaller than lists and shared when empty, and
+        intern their text and attribute values, which repeat a lot (values,
+        footprints, pin numbers...).  addChild() and getChildren() turn
+        the tuple of an element back into a list, so that frozen elements
+        can still be modified."""
+        pending = [self]
+        while pending:
+            element = pending.pop()
+            if element.children:
+                pending.extend(element.children)
+            element.children = tuple(element.children)
+            if type(element.chars) == str:
+                element.chars = sys.intern(element.chars)
+            attributes = element.attributes
+            for attr in attributes:
+                if type(attributes[attr]) == str:
+                    attributes[attr] = sys.intern(attributes[attr])
+
     def getParent(self):
         """Get the parent of this element (Could be None)"""
         return self.parent
@@ -212,6 +327,9 @@ class xmlElement():
                     ret.append(child)
             return ret
         else:
+            # the live list of children, callers may modify it
+            if type(self.children) is tuple:
+                self.children = list(self.children)
             return self.children
 
     def get(self, elemName, attribute="", attrmatch=""):
@@ -250,41 +368,114 @@ class xmlElement():
 
 
 
+# serializers write to their file once they have this many strings to join
+_WRITE_PARTS = 8192
+
+
+_INDENTS = [""]
+
+
+def _indent(level):
+    while len(_INDENTS) <= level:
+        _INDENTS.append("    " * len(_INDENTS))
+    return _INDENTS[level]
+
+
+_ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\t": "&#9;"}
+
+
+def _escape(text):
+    # most of the text of a netlist has nothing to escape
+    if "&" in text or "<" in text or ">" in text:
+        return escape(text)
+    return text
+
+
+def _escapeAttribute(value):
+    for c in "&<>\"\n\t":
+        if c in value:
+            return escape(value, _ATTRIBUTE_ENTITIES)
+    return value
+
+
+# the data of libpart and comp elements read by their accessors
+_LibPartData = namedtuple('_LibPartData',
+                          'lib part description fields fieldNames')
+_CompData = namedtuple('_CompData',
+                       'ref value footprint datasheet lib part description fields fieldNames')
+
+
+def _fieldMap(element):
+    """Return a dict of the field names to the field values found below
+    element, the same values element.get("field", "name", name) returns:
+    the first non empty field of that name in document order.
+    """
+    fields = {}
+    pending = [element]
+    while pending:
+        e = pending.pop()
+        if e.name == "field" and e.chars != "":
+            name = e.attributes.get("name")
+            if name is not None and name not in fields:
+                fields[name] = e.chars
+        pending.extend(reversed(e.children))
+    return fields
+
+
+def _childFieldNames(element):
+    fieldNames = []
+    fields = element.getChild('fields')
+    if fields:
+        for f in fields.children:
+            fieldNames.append( f.get('field','name') )
+    return fieldNames
+
+
 class libpart():
     """Class for a library part, aka 'libpart' in the xml netlist file.
     (Components in eeschema are instantiated from library parts.)
     This part class is implemented by wrapping an xmlElement with accessors.
     This xmlElement instance is held in field 'element'.
+
+    The data of the element is read once, on first access, and kept in the
+    field '_cache'.
     """
     def __init__(self, xml_element):
         #
         self.element = xml_element
+        self._cache = None
+
+    def _data(self):
+        if self._cache is None:
+            e = self.element
+            self._cache = _LibPartData(
+                e.get("libpart", "lib"),
+                e.get("libpart", "part"),
+                e.get("description"),
+                _fieldMap(e),
+                _childFieldNames(e))
+        return self._cache
 
     #def __str__(self):
         # simply print the xmlElement associated with this part
         #return str(self.element)
 
     def getLibName(self):
-        return self.element.get("libpart", "lib")
+        return self._data().lib
 
     def getPartName(self):
-        return self.element.get("libpart", "part")
+        return self._data().part
 
     def getDescription(self):
-        return self.element.get("description")
+        return self._data().description
 
     def getField(self, name):
-        return self.element.get("field", "name", name)
+        return self._data().fields.get(name, "")
 
     def getFieldNames(self):
         """Return a list of field names in play for this libpart.
         """
-        fieldNames = []
-        fields = self.element.getChild('fields')
-        if fields:
-            for f in fields.getChildren():
-                fieldNames.append( f.get('field','name') )
-        return fieldNames
+        return list(self._data().fieldNames)
 
     def getPinList(self):
         """Return a list of pins in play for this libpart.
@@ -292,7 +483,7 @@ class libpart():
         pinList = []
         pins = self.element.getChild('pins')
         if pins:
-            for f in pins.getChildren():
+            for f in pins.children:
                 pinList.append( f )
         return pinList
 
@@ -307,7 +498,7 @@ class libpart():
         aliases = self.element.getChild("aliases")
         if aliases:
             ret = []
-            children = aliases.getChildren()
+            children = aliases.children
             # grab the text out of each child:
             for child in children:
                 ret.append( child.get("alias") )
@@ -328,6 +519,33 @@ class comp():
         # Set to true when this component is included in a component group
         self.grouped = False
 
+        # The data of the element, read once on first access.  Call
+        # invalidate() after modifying the element other than by setValue()
+        self._cache = None
+
+    def _data(self):
+        if self._cache is None:
+            e = self.element
+            # libsource attributes are optional, description in particular
+            libsource = e.getChild("libsource")
+            source = libsource.attributes if libsource is not None else {}
+            self._cache = _CompData(
+                e.get("comp", "ref"),
+                e.get("value"),
+                e.get("footprint"),
+                e.get("datasheet"),
+                source.get("lib", ""),
+                source.get("part", ""),
+                source.get("description", ""),
+                _fieldMap(e),
+                _childFieldNames(e))
+        return self._cache
+
+    def invalidate(self):
+        """Forget the data read from the element, it is read again on next
+        access"""
+        self._cache = None
+
     def __eq__(self, other):
         """ Equivalency operator, remember this can be easily overloaded
             2 components are equivalent ( i.e. can be grouped
@@ -342,6 +560,9 @@ class comp():
                 kicad_netlist_reader.comp.__eq__ = myEqu
             in your bom generator script before calling the netliste reader by something like:
                 net = kicad_netlist_reader.netlist(sys.argv[1])
+
+            Grouping is much faster with a key function instead, see
+            netlist.groupComponents() and comp.groupKey()
         """
         result = False
         if self.getValue() == other.getValue():
@@ -350,6 +571,13 @@ class comp():
                     result = True
         return result
 
+    def groupKey(self):
+        """ Return a hashable key, 2 components have the same key when they
+            are equivalent according to the default equivalency operator
+        """
+        return (self.getValue(), self.getFootprint(),
+                self.getRef().rstrip(string.digits))
+
     def setLibPart(self, part):
         self.libpart = part
 
@@ -357,19 +585,20 @@ class comp():
         return self.libpart
 
     def getPartName(self):
-        return self.element.get("libsource", "part")
+        return self._data().part
 
     def getLibName(self):
-        return self.element.get("libsource", "lib")
+        return self._data().lib
 
     def setValue(self, value):
         """Set the value of this component"""
         v = self.element.getChild("value")
         if v:
             v.setChars(value)
+            self.invalidate()
 
     def getValue(self):
-        return self.element.get("value")
+        return self._data().value
 
     def getField(self, name, aLibraryToo = True):
         """
@@ -384,7 +613,7 @@ class comp():
                         in component itself
         """
 
-        field = self.element.get("field", "name", name)
+        field = self._data().fields.get(name, "")
         if field == "" and aLibraryToo and self.libpart:
             field = self.libpart.getField(name)
         return field
@@ -395,22 +624,17 @@ class comp():
         The netlist format only includes fields with non-empty values.  So if a field
         is empty, it will not be present in the returned list.
         """
-        fieldNames = []
-        fields = self.element.getChild('fields')
-        if fields:
-            for f in fields.getChildren():
-                fieldNames.append( f.get('field','name') )
-        return fieldNames
+        return list(self._data().fieldNames)
 
     def getRef(self):
-        return self.element.get("comp", "ref")
+        return self._data().ref
 
     '''
     return the footprint name. if empty and aLibraryToo = True, return the
     footprint name from libary
     '''
     def getFootprint(self, aLibraryToo = True):
-        ret = self.element.get("footprint")
+        ret = self._data().footprint
 
         if ret == "" and aLibraryToo and self.libpart:
             ret = self.libpart.getFootprint()
@@ -422,7 +646,7 @@ class comp():
     datasheet name from libary
     '''
     def getDatasheet(self, aLibraryToo = True):
-        ret = self.element.get("datasheet")
+        ret = self._data().datasheet
         if ret == "" and aLibraryToo and self.libpart:
             ret = self.libpart.getDatasheet()
         return ret
@@ -439,42 +663,102 @@ class comp():
         return ret
 
     def getDescription(self):
-        return self.element.get("libsource", "description")
+        return self._data().description
 
     '''
     return the netname of the pin aPinNum in netlist aNetlist
     if aSkipEmptyNet = True, net having only one pin will return a empty name
     '''
     def getPinNetname(self, aPinNum, aNetlist, aSkipEmptyNet):
-        ref = self.getRef()
+        net = aNetlist.getPinNet(self.getRef(), aPinNum)
+        if net is None:
+            return "?"
 
-        for net in aNetlist.nets:
-            net_name = net.get( "net", "name" )
+        if aSkipEmptyNet and len(net.children) < 2:   #ensure at least 2 pins are in net
+            return ""
 
-            item_cnt = 1
-            netitems = net.children
+        return net.get( "net", "name" )
 
-            for node in netitems:
-                curr_item_ref = node.get( "node", "ref" )
 
-                if curr_item_ref == ref:
-                    curr_pin = node.get( "node", "pin" )
+# the default equivalency operator, to tell whether it has been overridden
+_comp_eq = comp.__eq__
 
-                    if aPinNum == curr_pin:
-                        if aSkipEmptyNet:   #ensure at least 2 pins are in net
-                            pin_count = 0
 
-                            for curr_node in netitems:
-                                pin_count += 1
+@lru_cache(maxsize=64)
+def _compilePatterns(patterns):
+    """Compile a tuple of regular expressions into as few as possible, the
+    ones without groups are combined into a single alternation.  Patterns
+    with groups are kept apart, as combining them would renumber their
+    backreferences."""
+    combined = []
+    separate = []
+    for pattern in patterns:
+        compiled = re.compile(pattern)
+        if compiled.groups:
+            separate.append(compiled)
+        else:
+            combined.append(pattern)
+
+    if len(combined) > 1:
+        try:
+            return [re.compile('|'.join('(?:%s)' % p for p in combined))] + separate
+        except re.error:
+            # e.g. inline flags, which are only allowed at the start
+            pass
+    return [re.compile(p) for p in combined] + separate
 
-                                if pin_count > 1:
-                                    return net_name
 
-                            return ""
-                        else:
-                            return net_name
+def _matchesAny(compiled, text):
+    for rex in compiled:
+        if rex.match(text):
+            return True
+    return False
 
-        return "?"
+
+class ComponentFilter():
+    """Selects the components which show up in the BOM, those not excluded by
+    reference, value or footprint, nor marked as not populated.  The
+    regular expressions are compiled once, see netlist.getInterestingComponents().
+
+    Keywords (all default to the lists of the configure section):
+    references -- regular expressions matching excluded references
+    values -- regular expressions matching excluded values
+    footprints -- regular expressions matching excluded footprints
+    dnpFields -- dict of field names to the values marking components as not
+    populated
+
+    """
+    def __init__(self, references=None, values=None, footprints=None, dnpFields=None):
+        if references is None:
+            references = excluded_references
+        if values is None:
+            values = excluded_values
+        if footprints is None:
+            footprints = excluded_footprints
+        if dnpFields is None:
+            dnpFields = dnp_fields
+
+        self.references = _compilePatterns(tuple(references))
+        self.values = _compilePatterns(tuple(values))
+        self.footprints = _compilePatterns(tuple(footprints))
+        self.dnpFields = [(name, frozenset(dnpFields[name])) for name in dnpFields]
+
+    def __call__(self, c):
+        """Return True if the component c shows up in the BOM"""
+        if self.references and _matchesAny(self.references, c.getRef()):
+            return False
+        if self.values and _matchesAny(self.values, c.getValue()):
+            return False
+        if self.footprints and _matchesAny(self.footprints, c.getFootprint()):
+            return False
+        for name, flags in self.dnpFields:
+            if c.getField(name) in flags:
+                return False
+        return True
+
+    def filter(self, components):
+        """Return the components which show up in the BOM, in order"""
+        return [c for c in components if self(c)]
 
 
 class netlist():
@@ -483,11 +767,13 @@ class netlist():
     scripts
 
     """
-    def __init__(self, fname=""):
+    def __init__(self, fname="", backend=None, sections=None):
         """Initialiser for the genericNetlist class
 
         Keywords:
         fname -- The name of the generic netlist file to open (Optional)
+        backend -- The parser to load it with, see netlist_backend (Optional)
+        sections -- The sections of the netlist to load, see load() (Optional)
 
         """
         self.design = None
@@ -501,13 +787,24 @@ class netlist():
 
         self._curr_element = None
 
-        # component blacklist regexs, made from excluded_* above.
-        self.excluded_references = []
-        self.excluded_values = []
-        self.excluded_footprints = []
+        # sections skipped when loading: name -> (start, end) byte offsets in
+        # the file, which is expected to be unchanged when they are parsed
+        self._deferred = {}
+        self._source = None
+        self._sourceStat = None
+        self._backend = None
+
+        # (lib, part name) and (lib, alias) -> libpart, filled while parsing
+        self._libpartIndex = {}
+
+        # connectivity index, built once the netlist is loaded:
+        # (ref, pin) -> net, net name -> nodes and ref -> pins
+        self._pinNets = {}
+        self._netNodes = {}
+        self._refPins = {}
 
         if fname != "":
-            self.load(fname)
+            self.load(fname, backend, sections)
 
     def addChars(self, content):
         """Add characters to the current element"""
@@ -546,24 +843,41 @@ class netlist():
 
     def endDocument(self):
         """Called when the netlist document has been fully parsed"""
+        self._linkComponents()
+
+        # the tree is complete, shrink it before indexing its children
+        self.tree.freeze()
+        self._indexConnectivity()
+
+    @_traced('netlist.link')
+    def _linkComponents(self):
         # When the document is complete, the library parts must be linked to
         # the components as they are separate in the tree so as not to
         # duplicate library part information for every component
         for c in self.components:
-            for p in self.libparts:
-                if p.getLibName() == c.getLibName():
-                    if p.getPartName() == c.getPartName():
-                        c.setLibPart(p)
-                        break
-                    else:
-                        aliases = p.getAliases()
-                        if aliases and self.aliasMatch( c.getPartName(), aliases ):
-                            c.setLibPart(p)
-                            break;
+            p = self._libpartIndex.get((c.getLibName(), c.getPartName()))
+            if p:
+                c.setLibPart(p)
 
             if not c.getLibPart():
                 print( 'missing libpart for ref:', c.getRef(), c.getPartName(), c.getLibName() )
 
+    @_traced('netlist.index')
+    def _indexConnectivity(self):
+        """Index which net every pin is connected to, so that pin and net
+        queries don't have to scan all the nets"""
+        for net in self.nets:
+            nodes = net.children
+            self._netNodes.setdefault(net.get("net", "name"), nodes)
+
+            for node in nodes:
+                ref = node.get("node", "ref")
+                pin = node.get("node", "pin")
+                # a pin listed in several nets belongs to the first one
+                if (ref, pin) not in self._pinNets:
+                    self._pinNets[(ref, pin)] = net
+                    self._refPins.setdefault(ref, []).append(pin)
+
 
     def aliasMatch(self, partName, aliasList):
         for alias in aliasList:
@@ -571,30 +885,111 @@ class netlist():
                 return True
         return False
 
+    def _indexLibPart(self, part):
+        """Make a library part available for linking by name and aliases.
+        The first library part declaring a name or alias wins, as the parts
+        are looked up in document order."""
+        lib = part.getLibName()
+        self._libpartIndex.setdefault((lib, part.getPartName()), part)
+        for alias in part.getAliases() or []:
+            self._libpartIndex.setdefault((lib, alias), part)
+
     def endElement(self):
         """End the current element and switch to its parent"""
+        # The library part is complete, aliases included
+        if self._curr_element.name == "libpart":
+            self._indexLibPart(self.libparts[-1])
+
         self._curr_element = self._curr_element.getParent()
 
+    def _require(self, *names):
+        """Parse the sections skipped when loading among names"""
+        for name in names:
+            if name in self._deferred:
+                self._loadSection(name)
+
+    @_traced('netlist.loadSection')
+    def _loadSection(self, name):
+        """Parse a section skipped when loading into the tree, where it has
+        been left empty, and index it like the rest of the netlist"""
+        start, end = self._deferred[name]
+        if _fileStat(self._source) != self._sourceStat:
+            raise RuntimeError('%s changed since it was loaded, its %s can\'t be read'
+                               % (self._source, name))
+        with open(self._source, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+        section = _netlistSection()
+        loaders[self._backend](section, io.BytesIO(data))
+        del self._deferred[name]
+
+        placeholder = self.tree.getChild(name)
+        placeholder.attributes = section.tree.attributes
+        placeholder.chars = section.tree.chars
+        placeholder.children = section.tree.children
+        for child in placeholder.children:
+            child.parent = placeholder
+
+        if section.design is not None:
+            self.design = section.design
+        self.components.extend(section.components)
+        self.libparts.extend(section.libparts)
+        self.libraries.extend(section.libraries)
+        self.nets.extend(section.nets)
+
+        for part in section.libparts:
+            self._indexLibPart(part)
+        if name in _LINKED_SECTIONS and not _LINKED_SECTIONS & set(self._deferred):
+            self._linkComponents()
+        if name == "nets":
+            self._indexConnectivity()
+
     def getDate(self):
         """Return the date + time string generated by the tree creation tool"""
+        self._require("design")
         return self.design.get("date")
 
     def getSource(self):
         """Return the source string for the design"""
+        self._require("design")
         return self.design.get("source")
 
     def getTool(self):
         """Return the tool string which was used to create the netlist tree"""
+        self._require("design")
         return self.design.get("tool")
 
     def getNets(self):
         """Return the nets """
+        self._require("nets")
         return self.nets
 
+    def getPinNet(self, ref, pin):
+        """Return the net element pin 'pin' of component 'ref' is connected
+        to, or None if the pin is not in any net"""
+        self._require("nets")
+        return self._pinNets.get((ref, pin))
+
+    def getComponentNets(self, ref):
+        """Return a dict of the pins of component 'ref' to the names of the
+        nets they are connected to"""
+        self._require("nets")
+        nets = {}
+        for pin in self._refPins.get(ref, []):
+            nets[pin] = self._pinNets[(ref, pin)].get("net", "name")
+        return nets
+
+    def getNetNodes(self, name):
+        """Return the node elements (ref and pin) of the net named 'name'"""
+        self._require("nets")
+        return self._netNodes.get(name, [])
+
     def gatherComponentFieldUnion(self, components=None):
         """Gather the complete 'set' of unique component fields, fields found in any component.
         """
         if not components:
+            self._require(*_LINKED_SECTIONS)
             components=self.components
 
         s = set()
@@ -602,91 +997,41 @@ class netlist():
             s.update( c.getFieldNames() )
 
         # omit anything matching any regex in excluded_fields
-        ret = set()
-        for field in s:
-            exclude = False
-            for rex in excluded_fields:
-                if re.match( rex, field ):
-                    exclude = True
-                    break
-            if not exclude:
-                ret.add(field)
-
-        return ret       # this is a python 'set'
+        excluded = _compilePatterns(tuple(excluded_fields))
+        return set(field for field in s if not _matchesAny(excluded, field))
 
     def gatherLibPartFieldUnion(self):
         """Gather the complete 'set' of part fields, fields found in any part.
         """
+        self._require(*_LINKED_SECTIONS)
         s = set()
         for p in self.libparts:
             s.update( p.getFieldNames() )
 
         # omit anything matching any regex in excluded_fields
-        ret = set()
-        for field in s:
-            exclude = False
-            for rex in excluded_fields:
-                if re.match( rex, field ):
-                    exclude = True
-                    break
-            if not exclude:
-                ret.add(field)
-
-        return ret       # this is a python 'set'
-
-    def getInterestingComponents(self):
+        excluded = _compilePatterns(tuple(excluded_fields))
+        return set(field for field in s if not _matchesAny(excluded, field))
+
+    @_traced('netlist.getInterestingComponents')
+    def getInterestingComponents(self, componentFilter=None):
         """Return a subset of all components, those that should show up in the BOM.
         Omit those that should not, by consulting the blacklists:
         excluded_values, excluded_refs, and excluded_footprints, which hold one
         or more regular expressions.  If any of the regular expressions match
         the corresponding field's value in a component, then the component is excluded.
-        """
+        Components flagged as not populated by dnp_fields are excluded too.
 
-        # pre-compile all the regex expressions:
-        del self.excluded_references[:]
-        del self.excluded_values[:]
-        del self.excluded_footprints[:]
-
-        for rex in excluded_references:
-            self.excluded_references.append( re.compile( rex ) )
-
-        for rex in excluded_values:
-            self.excluded_values.append( re.compile( rex ) )
+        Keywords:
+        componentFilter -- the ComponentFilter to use instead of one made from
+        the configure section.  Build it once to select components repeatedly.
+        """
+        self._require(*_LINKED_SECTIONS)
 
-        for rex in excluded_footprints:
-            self.excluded_footprints.append( re.compile( rex ) )
+        if componentFilter is None:
+            componentFilter = ComponentFilter()
 
         # the subset of components to return, considered as "interesting".
-        ret = []
-
-        # run each component thru a series of tests, if it passes all, then add it
-        # to the interesting list 'ret'.
-        for c in self.components:
-            exclude = False
-            if not exclude:
-                for refs in self.excluded_references:
-                    if refs.match(c.getRef()):
-                        exclude = True
-                        break;
-            if not exclude:
-                for vals in self.excluded_values:
-                    if vals.match(c.getValue()):
-                        exclude = True
-                        break;
-            if not exclude:
-                for mods in self.excluded_footprints:
-                    if mods.match(c.getFootprint()):
-                        exclude = True
-                        break;
-
-            if not exclude:
-                # This is a fairly personal way to flag DNS (Do Not Stuff).  NU for
-                # me means Normally Uninstalled.  You can 'or in' another expression here.
-                if c.getField( "Installed" ) == 'NU':
-                    exclude = True
-
-            if not exclude:
-                ret.append(c)
+        ret = componentFilter.filter(self.components)
 
         # The key to sort the components in the BOM
         # This sorts using a natural sorting order (e.g. 100 after 99), and if it wasn't used
@@ -700,17 +1045,61 @@ class netlist():
         return ret
 
 
-    def groupComponents(self, components = None):
+    @_traced('netlist.groupComponents')
+    def groupComponents(self, components = None, key = None, componentFilter = None):
         """Return a list of component lists. Components are grouped together
         when the value, library and part identifiers match.
 
         Keywords:
         components -- is a list of components, typically an interesting subset
         of all components, or None.  If None, then all components are looked at.
+        key -- a function returning a hashable key for a component, components
+        with the same key are grouped together.  Defaults to comp.groupKey,
+        unless comp.__eq__ has been overridden, in which case the components
+        are compared with each other as before.
+        componentFilter -- a ComponentFilter, only the components it accepts
+        are grouped.
         """
         if not components:
+            self._require(*_LINKED_SECTIONS)
             components = self.components
 
+        if componentFilter is not None:
+            components = componentFilter.filter(components)
+
+        if key is None and comp.__eq__ is _comp_eq:
+            key = comp.groupKey
+
+        if key is not None:
+            # One key per component and a bucket per key, groups and the
+            # components inside of them keep the order of components
+            buckets = {}
+            for c in components:
+                buckets.setdefault(key(c), []).append(c)
+                c.grouped = True
+            groups = list(buckets.values())
+        else:
+            groups = self._groupComponentsByEquality(components)
+
+        # The key to sort the components in the BOM
+        # This sorts using a natural sorting order (e.g. 100 after 99), and if it wasn't used
+        # the normal sort would place 100 before 99 since it only would look at the first digit.
+        def sortKey( str ):
+            return [ int(t) if t.isdigit() else t.lower()
+                    for t in re.split( '(\d+)', str ) ]
+
+        for g in groups:
+            #g = sorted(g, key=lambda g: sortKey(g.getRef()))
+            g.sort(key=lambda g: sortKey(g.getRef()))
+
+        # Finally, sort the groups to order the references alphabetically
+        groups.sort(key=lambda group: sortKey(group[0].getRef()))
+
+        return groups
+
+    def _groupComponentsByEquality(self, components):
+        """Group the components by comparing each of them with the others,
+        for a user defined comp.__eq__"""
         groups = []
 
         # Make sure to start off will all components ungrouped to begin with
@@ -734,20 +1123,6 @@ class netlist():
                 # Add the new component group to the groups list
                 groups.append(newgroup)
 
-        # The key to sort the components in the BOM
-        # This sorts using a natural sorting order (e.g. 100 after 99), and if it wasn't used
-        # the normal sort would place 100 before 99 since it only would look at the first digit.
-        def sortKey( str ):
-            return [ int(t) if t.isdigit() else t.lower()
-                    for t in re.split( '(\d+)', str ) ]
-
-        for g in groups:
-            #g = sorted(g, key=lambda g: sortKey(g.getRef()))
-            g.sort(key=lambda g: sortKey(g.getRef()))
-
-        # Finally, sort the groups to order the references alphabetically
-        groups.sort(key=lambda group: sortKey(group[0].getRef()))
-
         return groups
 
     def getGroupField(self, group, field):
@@ -795,27 +1170,141 @@ class netlist():
 
     def formatXML(self):
         """Return the whole netlist formatted in XML"""
+        self._require(*list(self._deferred))
         return self.tree.formatXML()
 
+    @_traced('netlist.writeXML')
+    def writeXML(self, f):
+        """Write the whole netlist formatted in XML to the file-like object f"""
+        self._require(*list(self._deferred))
+        self.tree.writeXML(f)
+
     def formatHTML(self):
         """Return the whole netlist formatted in HTML"""
+        self._require(*list(self._deferred))
         return self.tree.formatHTML()
 
-    def load(self, fname):
+    @_traced('netlist.writeHTML')
+    def writeHTML(self, f):
+        """Write the whole netlist formatted in HTML to the file-like object f"""
+        self._require(*list(self._deferred))
+        self.tree.writeHTML(f)
+
+    @_traced('netlist.load')
+    def load(self, fname, backend=None, sections=None):
         """Load a kicad generic netlist
 
         Keywords:
         fname -- The name of the generic netlist file to open
+        backend -- The parser to load it with, see netlist_backend
+        sections -- The top level sections to load (design, components,
+        libparts, libraries and nets), or None for all of them.  The others
+        are only located in the file and parsed the first time they are
+        needed, e.g. the nets by getNets().  Components and library parts
+        are always loaded together, as they are linked to each other.
 
         """
+        if backend is None:
+            backend = defaultBackend()
+
+        if sections is not None:
+            unknown = set(sections) - set(_SECTIONS)
+            if unknown:
+                raise ValueError('Unknown netlist sections: ' + ', '.join(sorted(unknown)))
+            sections = set(sections)
+            if sections & _LINKED_SECTIONS:
+                sections |= _LINKED_SECTIONS
+            if sections == set(_SECTIONS) or hasattr(fname, 'read'):
+                sections = None
+
         try:
-            self._reader = sax.make_parser()
-            self._reader.setContentHandler(_gNetReader(self))
-            self._reader.parse(fname)
+            cacheKey = None
+            if netlist_cache and not hasattr(fname, 'read'):
+                cacheKey = _cacheKey(fname, sections)
+                cached = _readCache(cacheKey)
+                if cached is not None:
+                    self.__dict__.update(cached.__dict__)
+                    if self._deferred:
+                        # same content, the offsets of the sections still hold
+                        self._source = os.path.abspath(fname)
+                        self._sourceStat = _fileStat(fname)
+                    return
+
+            if sections is None:
+                loaders[backend](self, fname)
+            else:
+                self._loadSections(fname, backend, sections)
         except IOError as e:
             print( __file__, ":", e, file=sys.stderr )
             sys.exit(-1)
 
+        if cacheKey is not None:
+            _writeCache(cacheKey, self)
+
+    def _loadSections(self, fname, backend, sections):
+        """Load the given sections only, the others are cut out of the
+        document, leaving an empty element behind, until they are needed"""
+        with open(fname, 'rb') as f:
+            self._sourceStat = _fileStat(f.fileno())
+            data = f.read()
+        self._source = os.path.abspath(fname)
+        self._backend = backend
+
+        skipped = [name for name in _SECTIONS if name not in sections]
+        self._deferred = _sectionSpans(data, skipped)
+
+        parts = []
+        position = 0
+        for name, (start, end) in sorted(self._deferred.items(), key=lambda s: s[1]):
+            parts.append(data[position:start])
+            parts.append(b'<' + name.encode() + b'/>')
+            position = end
+        parts.append(data[position:])
+        del data
+
+        loaders[backend](self, io.BytesIO(b''.join(parts)))
+
+    def __getstate__(self):
+        """The parsing state is not kept when pickling, e.g. in the cache"""
+        state = self.__dict__.copy()
+        state.pop('_reader', None)
+        state['_curr_element'] = None
+        return state
+
+
+
+class _netlistSection(netlist):
+    """A section of a netlist parsed on its own, which is linked and indexed
+    once it is part of the netlist, see netlist._loadSection()"""
+    def endDocument(self):
+        self.tree.freeze()
+
+
+# the top level sections of a netlist
+_SECTIONS = ('design', 'components', 'libparts', 'libraries', 'nets')
+_LINKED_SECTIONS = {'components', 'libparts'}
+
+
+def _sectionSpans(data, names):
+    """Return the (start, end) byte offsets of the top level sections named
+    names in the netlist document data.  Each of these elements appears only
+    once in a netlist, as its children have other names."""
+    spans = {}
+    for name in names:
+        start = data.find(b'<' + name.encode() + b'>')
+        if start < 0:
+            continue
+        endTag = b'</' + name.encode() + b'>'
+        end = data.find(endTag, start)
+        if end >= 0:
+            spans[name] = (start, end + len(endTag))
+    return spans
+
+
+def _fileStat(f):
+    """Return what tells whether the file f (a name or descriptor) changed"""
+    st = os.stat(f)
+    return (st.st_size, st.st_mtime_ns)
 
 
 class _gNetReader(sax.handler.ContentHandler):
@@ -845,3 +1334,188 @@ class _gNetReader(sax.handler.ContentHandler):
     def endDocument(self):
         """End of the XML document event"""
         self.parent.endDocument()
+
+
+# Loaders turning a netlist file into calls to the netlist's addElement(),
+# addAttribute() of the new element, addChars(), endElement() and finally
+# endDocument(), which build the netlist object model.  They all build the
+# same model: text which is only whitespace is dropped, as expat delivers it
+# to the SAX reader in chunks split at line breaks.  The etree and lxml
+# loaders only differ for whitespace next to entity references, which the
+# SAX reader also gets as chunks of their own.
+
+@_traced('netlist.parse')
+def _loadSax(net, fname):
+    net._reader = sax.make_parser()
+    net._reader.setContentHandler(_gNetReader(net))
+    net._reader.parse(fname)
+
+
+_SAX_BUFFER_SIZE = 2**16
+
+
+@_traced('netlist.parse')
+def _loadExpat(net, fname):
+    """The SAX reader without the SAX layers in between"""
+    def startElement(name, attrs):
+        element = net.addElement(name)
+        for attr in attrs:
+            element.addAttribute(attr, attrs[attr])
+
+    def endElement(name):
+        net.endElement()
+
+    def characters(content):
+        if not content.isspace():
+            net.addChars(content)
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = startElement
+    parser.EndElementHandler = endElement
+    parser.CharacterDataHandler = characters
+
+    # fed in the same blocks as the SAX reader, expat also splits text at
+    # their boundaries
+    f = fname if hasattr(fname, 'read') else open(fname, 'rb')
+    try:
+        while True:
+            data = f.read(_SAX_BUFFER_SIZE)
+            if not data:
+                break
+            parser.Parse(data, False)
+        parser.Parse(b'', True)
+    finally:
+        if f is not fname:
+            f.close()
+    net.endDocument()
+
+
+def _addText(net, text):
+    """Add text as the SAX reader would: the chunks between line breaks
+    which are only whitespace are dropped"""
+    if text:
+        for chunk in text.split('\n'):
+            if chunk and not chunk.isspace():
+                net.addChars(chunk)
+
+
+@_traced('netlist.parse')
+def _loadIterparse(net, fname, etree):
+    for event, elem in etree.iterparse(fname, events=('start', 'end')):
+        if event == 'start':
+            element = net.addElement(elem.tag)
+            for attr, value in elem.attrib.items():
+                element.addAttribute(attr, value)
+        else:
+            # the text of an element is its own text and the text following
+            # each of its children
+            _addText(net, elem.text)
+            for child in elem:
+                _addText(net, child.tail)
+            # the children have been turned into xmlElements already
+            del elem[:]
+            net.endElement()
+    net.endDocument()
+
+
+def _loadEtree(net, fname):
+    _loadIterparse(net, fname, ElementTree)
+
+
+def _loadLxml(net, fname):
+    if lxml_etree is None:
+        raise RuntimeError('The lxml netlist backend needs the lxml module')
+    _loadIterparse(net, fname, lxml_etree)
+
+
+# Bump when the object model changes, older cache entries are then ignored
+_CACHE_VERSION = 2
+
+
+def cacheDirectory():
+    """Return the directory of the netlist cache"""
+    if netlist_cache_dir is not None:
+        return netlist_cache_dir
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'kirelease', 'netlists')
+
+
+def _cacheKey(fname, sections=None):
+    digest = hashlib.sha256()
+    digest.update(('%d:' % _CACHE_VERSION).encode())
+    if sections is not None:
+        digest.update((','.join(sorted(sections)) + ':').encode())
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@_traced('netlist.readCache')
+def _readCache(key):
+    entry = os.path.join(cacheDirectory(), key + '.pickle')
+    try:
+        with open(entry, 'rb') as f:
+            net = pickle.load(f)
+        # most recently used entries have the newest modification time
+        os.utime(entry)
+        return net
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # unreadable or from an incompatible version, parse again
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+        return None
+
+
+@_traced('netlist.writeCache')
+def _writeCache(key, net):
+    directory = cacheDirectory()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(net, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, os.path.join(directory, key + '.pickle'))
+        except BaseException:
+            os.remove(temp)
+            raise
+        _evictCache(directory)
+    except (OSError, pickle.PicklingError, RecursionError):
+        # the cache is only an optimization
+        pass
+
+
+def _evictCache(directory):
+    """Remove the least recently used entries above netlist_cache_max_bytes"""
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if name.endswith('.pickle'):
+            st = os.stat(os.path.join(directory, name))
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+    entries.sort()
+    while total > netlist_cache_max_bytes and entries:
+        mtime, size, name = entries.pop(0)
+        os.remove(os.path.join(directory, name))
+        total -= size
+
+
+loaders = {
+    'sax': _loadSax,
+    'expat': _loadExpat,
+    'etree': _loadEtree,
+    'lxml': _loadLxml,
+}
+
+
+def defaultBackend():
+    """Return the netlist parser in use when none is given"""
+    if netlist_backend is not None:
+        return netlist_backend
+    return 'lxml' if lxml_etree is not None else 'expat'
@@ -1,79 +1,577 @@
 #!/usr/bin/env python
 
-from os import listdir, getcwd, mkdir, path, rename
+from os import listdir, getcwd, getuid, getpid, mkdir, makedirs, path, remove, \
+    rename, replace, chmod, environ, walk, link, stat, fsync, cpu_count, umask
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import socketserver
+import contextlib
+import traceback
+import cProfile
+import signal
+import threading
+import asyncio
+import hashlib
+import socket
+import fcntl
+import queue
+import json
+import re
 import sys
 import time
 import csv
 import shutil
-import zipfile
 import tempfile
 
+try:
+    import tomllib
+except ImportError:
+    # before Python 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
 import kicad_netlist_reader
-import pcbnew
+# pcbnew is slow to import, the functions driving it import it themselves so
+# that submitting a release to the daemon never loads it
 
-from utils import xdotool, PopenContext
+from utils import xdotool, send_keys, wait_for_window, wait_for_file, \
+    wait_for_written_file, PopenContext, terminate_children, reset_cancellation, \
+    display_env, start_xvfb, stop_xvfb, StreamingArchive, archive_extension, \
+    ARCHIVE_FORMATS, file_digest, link_or_copy, start_tracing, stop_tracing, \
+    tracing, trace_span, trace_event, trace_name, take_trace_events, add_trace_events, \
+    traced
 
 KICAD_SCH_EXTENSION = '.kicad_sch'
 KICAD_PCB_EXTENSION = '.kicad_pcb'
 RELEASE_DIRECTORY_NAME = 'release'
+# kicad2step gets this long to write the model, plus some time for every
+# footprint since each of them can bring in a 3D model
+STEP_TIMEOUT = 30
+STEP_TIMEOUT_PER_FOOTPRINT = 0.5
+STEP_TRAILER = b'END-ISO-10303-21;'
+# eeschema gets this long to plot the whole schematic hierarchy
+SCHEMATIC_PLOT_TIMEOUT = 120
+PDF_TRAILER = b'%%EOF'
+# number of boards kept loaded by 'kirelease serve'
+BOARD_CACHE_SIZE = 8
+
+# content addressed store in the release directory, release folders hold hard
+# links to its blobs, named after the sha256 of their content
+STORE_DIRECTORY_NAME = '.store'
+
+# index of the releases in the release directory: project name, next release
+# number and, for every release, its status, timestamps, the fingerprints of
+# the inputs of its stages and the sha256 of its artifacts
+INDEX_FILE = 'index.json'
+INDEX_LOCK_FILE = '.index.lock'
+RELEASE_NAME = re.compile(r'^(.+)_release_(\d+)$')
+
+# project files the schematic plot depends on, sub-sheets included
+SCHEMATIC_INPUTS = ('.kicad_sch', '.kicad_pro', 'sym-lib-table')
+# a pooled eeschema is restarted after this many plots
+SCHEMATIC_PLOTTER_MAX_JOBS = 50
+# milliseconds between the keystrokes sent to the eeschema plot dialog
+SCHEMATIC_KEY_DELAY = 12
 pcb_file = ''
 
+# boards loaded by pcbnew, keyed by file and ordered from least to most
+# recently used. Only enabled by 'kirelease serve', None otherwise
+boardCache = None
+
+# folder receiving a cProfile .pstats file for every in-process stage, set by
+# --profile
+profileDir = None
+
+# stage and plotting workers are started by a fork server: forking the
+# release while its threads print or start tools could hand the worker a lock
+# that is never released. The server imports kirelease and pcbnew once
+workerContext = multiprocessing.get_context('forkserver')
+workerContext.set_forkserver_preload(['__main__', 'pcbnew'])
 
-def getProjectName(outputDir):
-    # expected format: 'projectName_release_0', 'projectName_release_1', ...
-    releaseFiles = listdir(outputDir)
-    if len(releaseFiles) != 0:
-        temp = releaseFiles[0].split('_')
-        if len(temp) != 0 and temp[0] != '':
-            print("Project name is '" +
-                  temp[0] + "'. Got it from previous releases.")
-            return temp[0]
+# timeline rows of the stages in traces, clear of real thread ids
+STAGE_TRACE_TID = 0x7fff0000
 
-    if len(sys.argv) >= 4:
-        return sys.argv[3]
+
+def listReleases(outputDir):
+    """Return the (releaseNumber, projectName, folder name) of the release
+    folders in outputDir, in release order. Other entries are ignored."""
+    releases = []
+    for f in listdir(outputDir):
+        match = RELEASE_NAME.match(f)
+        if match and path.isdir(path.join(outputDir, f)):
+            releases.append((int(match.group(2)), match.group(1), f))
+    return sorted(releases)
+
+
+def scanReleases(outputDir):
+    # index of the releases made before there was one
+    releases = listReleases(outputDir)
+    index = {
+        'project': releases[0][1] if releases else None,
+        'next': releases[-1][0] + 1 if releases else 0,
+        'releases': {},
+    }
+    for releaseNumber, projectName, name in releases:
+        index['releases'][str(releaseNumber)] = {
+            'name': name,
+            'status': 'complete',
+            # made before fingerprints were recorded, nothing to reuse
+            'fingerprints': {},
+        }
+    return index
+
+
+@contextlib.contextmanager
+def releaseIndex(outputDir):
+    """Lock the index of the releases in outputDir and yield it, it is saved
+    when the block completes. Concurrent releases wait for the lock, so
+    they can't allocate the same release number."""
+    indexFile = path.join(outputDir, INDEX_FILE)
+    with open(path.join(outputDir, INDEX_LOCK_FILE), 'a') as lock:
+        # released when the lock file is closed
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            with open(indexFile) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = scanReleases(outputDir)
+        except ValueError:
+            print("'" + indexFile + "' is corrupted, rebuilding it from the release folders.")
+            index = scanReleases(outputDir)
+
+        yield index
+
+        # readers never see a partially written index
+        with open(indexFile + '.part', 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+            f.flush()
+            fsync(f.fileno())
+        replace(indexFile + '.part', indexFile)
+
+
+def getProjectName(index, projectName=''):
+    if index['project'] is not None:
+        print("Project name is '" +
+              index['project'] + "'. Got it from previous releases.")
+        return index['project']
+
+    if projectName != '':
+        index['project'] = projectName
+        return projectName
     else:
         print("Missing <projectName>, must be specified at first release.\n"
               "Use kirelease help for usage.")
         exit(0)
 
 
-def getReleaseNumber(outputDir):
-    nextRelease = -1
+def getReleaseNumber(index, outputDir):
+    # allocated under the index lock, skipping any folder created by hand
+    while True:
+        releaseNumber = index['next']
+        index['next'] = releaseNumber + 1
+        if not path.exists(path.join(outputDir, index['project'] +
+                                     '_release_' + str(releaseNumber))):
+            return releaseNumber
 
-    # expected format: 'projectName_release_0', 'projectName_release_1', ...
-    for f in listdir(outputDir):
-        temp = f.split('_')
-        temp = int(temp[len(temp) - 1])
-        if temp > nextRelease:
-            nextRelease = temp
 
-    if nextRelease == -1:
-        return 0
-    else:
-        return nextRelease + 1
+def previousRelease(index, outputDir, releaseNumber):
+    """Return the folder and stage fingerprints of the latest complete
+    release before releaseNumber, or (None, {})"""
+    for number in sorted((int(n) for n in index['releases']), reverse=True):
+        entry = index['releases'][str(number)]
+        if number < releaseNumber and entry.get('status') == 'complete' and \
+                path.isdir(path.join(outputDir, entry['name'])):
+            return path.join(outputDir, entry['name']), entry.get('fingerprints', {})
+    return None, {}
+
+
+def timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S%z')
 
 
 def checkForOutputFolder(outputDir):
     # check for release folder
     if not path.isdir(outputDir):
-        mkdir(RELEASE_DIRECTORY_NAME)
+        mkdir(outputDir)
         print("'release' directory created")
 
 
+class ReleaseStage():
+    """A single exporter of the release pipeline.
+
+    Stages that drive pcbnew in-process run in a worker process, the
+    others only wait on external tools (eeschema, kicad2step) and run in a
+    worker thread. A stage starts as soon as all the stages named in deps
+    have finished, deps are looked up among the stages of the same group:
+    the release folder of the stage, one per release. artifacts are the names of the files it writes in the release folder.
+    resource names the concurrency limit the stage counts against, see
+    runStages().
+    """
+
+    def __init__(self, name, func, args=(), deps=(), inProcess=False,
+                 artifacts=(), resource=None, group=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.inProcess = inProcess
+        self.artifacts = artifacts
+        self.resource = resource
+        self.group = group
+        self.duration = None
+        self.error = None
+
+
+def _callStage(name, func, args):
+    if profileDir is None:
+        return func(*args)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(path.join(profileDir, name.replace('/', '-') + '.pstats'))
+
+
+def _workerSettings():
+    return profileDir, tracing()
+
+
+def _initWorker(profile, withTracing):
+    # workers start from the fork server, not from the release, so they are
+    # told what the release was asked to record
+    global profileDir
+    profileDir = profile
+    if withTracing:
+        start_tracing()
+        kicad_netlist_reader.tracer = trace_span
+
+
+def _terminated(signum, frame):
+    raise SystemExit('Terminated')
+
+
+def _runInChild(conn, name, func, args, settings):
+    _initWorker(*settings)
+    # a cancelled stage still runs its cleanup: temporary files, partial
+    # archives and its plotting workers
+    signal.signal(signal.SIGTERM, _terminated)
+    # the spans of the worker go back to the parent along with the outcome
+    trace_name(name)
+    try:
+        _callStage(name, func, args)
+        conn.send((None, take_trace_events()))
+    except BaseException as e:
+        conn.send((RuntimeError(''.join(
+            traceback.format_exception(type(e), e, e.__traceback__))),
+            take_trace_events()))
+    finally:
+        sys.stdout.flush()
+        conn.close()
+
+
+def _waitForChild(process, conn):
+    try:
+        error, events = conn.recv()
+        add_trace_events(events)
+    except EOFError:
+        # the worker died without reporting, either killed or crashed
+        error = RuntimeError('Worker process exited with code ' +
+                             str(process.exitcode))
+    process.join()
+    if error is not None:
+        raise error
+
+
+async def _runStages(stages, useProcesses, limits, failFast):
+    loop = asyncio.get_running_loop()
+    threads = ThreadPoolExecutor(max_workers=len(stages))
+    semaphores = {resource: asyncio.Semaphore(limit)
+                  for resource, limit in (limits or {}).items()}
+    workers = []
+    tasks = {}
+    for stage in stages:
+        if (stage.group, stage.name) in tasks:
+            raise ValueError("Stage '" + stage.name + "' appears twice in " +
+                             str(stage.group))
+        tasks[(stage.group, stage.name)] = None
+
+    async def runStage(stage):
+        for dep in stage.deps:
+            await tasks[(stage.group, dep)]
+
+        semaphore = semaphores.get(stage.resource)
+        if semaphore is None:
+            await runStageNow(stage)
+        else:
+            async with semaphore:
+                await runStageNow(stage)
+
+    async def runStageNow(stage):
+        name = stage.name if stage.group is None else \
+            path.basename(stage.group) + '/' + stage.name
+        start = time.monotonic()
+        try:
+            if stage.inProcess and useProcesses:
+                parentConn, childConn = workerContext.Pipe(duplex=False)
+                process = workerContext.Process(
+                    target=_runInChild,
+                    args=(childConn, name, stage.func, stage.args, _workerSettings()))
+                process.start()
+                childConn.close()
+                workers.append(process)
+                await loop.run_in_executor(threads, _waitForChild, process, parentConn)
+            elif stage.inProcess:
+                await loop.run_in_executor(threads, _callStage, name, stage.func, stage.args)
+            else:
+                await loop.run_in_executor(threads, stage.func, *stage.args)
+            stage.duration = time.monotonic() - start
+        finally:
+            # every stage on a row of its own
+            tid = STAGE_TRACE_TID + stages.index(stage)
+            trace_name(name, tid)
+            trace_event(name, start, time.monotonic() - start, tid,
+                        resource=stage.resource, complete=stage.duration is not None)
+
+    for stage in stages:
+        tasks[(stage.group, stage.name)] = asyncio.ensure_future(runStage(stage))
+
+    try:
+        if not failFast:
+            # every stage runs, or fails along with the stages it depends on
+            results = await asyncio.gather(
+                *[tasks[(stage.group, stage.name)] for stage in stages],
+                return_exceptions=True)
+            for stage, result in zip(stages, results):
+                if isinstance(result, BaseException):
+                    stage.error = result
+            return
+
+        done, pending = await asyncio.wait(
+            tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+        failed = [t for t in done if t.exception() is not None]
+        if failed:
+            # stop whatever is still running before reporting the failure
+            for task in pending:
+                task.cancel()
+            terminate_children()
+            for process in workers:
+                if process.is_alive():
+                    process.terminate()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise failed[0].exception()
+    finally:
+        threads.shutdown(wait=True)
+        for process in workers:
+            process.join()
+
+
+def runStages(stages, useProcesses=True, limits=None, failFast=True):
+    """Run the release stages concurrently, respecting their dependencies.
+
+    limits maps a resource to the number of stages using it that may run at
+    the same time, e.g. {'gui': 1, 'cpu': 8}. When a stage fails the
+    pending stages are cancelled, running external tools and worker
+    processes are terminated and the error is re-raised. Unless failFast is
+    False: the other stages then carry on and the error of every failed
+    stage is left in its error attribute.
+    Returns a dict with the duration in seconds of every stage.
+    """
+    reset_cancellation()
+    asyncio.run(_runStages(stages, useProcesses, limits, failFast))
+    return {stage.name: stage.duration for stage in stages}
+
+
+def codeVersion():
+    # the artifacts also depend on the code of kirelease itself
+    digest = hashlib.sha256()
+    sourceDir = path.dirname(path.abspath(__file__))
+    for source in ('kirelease.py', 'utils.py', 'kicad_netlist_reader.py'):
+        digest.update(file_digest(path.join(sourceDir, source)).encode())
+    return digest.hexdigest()
+
+
+def projectFiles(projectDir, extensions):
+    found = []
+    for root, dirs, files in walk(projectDir):
+        # skip the release folder and hidden ones like .git
+        dirs[:] = sorted(d for d in dirs
+                         if d != RELEASE_DIRECTORY_NAME and not d.startswith('.'))
+        found += [path.join(root, f) for f in sorted(files) if f.endswith(extensions)]
+    return found
+
+
+def stageFingerprint(projectDir, name, inputFiles, options):
+    """Return a digest of everything the artifacts of a stage depend on:
+    the content of its input files, its options and the versions of KiCad
+    and of kirelease"""
+    import pcbnew
+    inputs = {
+        'stage': name,
+        'files': {path.relpath(f, projectDir): file_digest(f) for f in inputFiles},
+        'options': options,
+        'kicad': pcbnew.GetBuildVersion(),
+        'kirelease': codeVersion(),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def reuseArtifacts(stage, previousDir, releaseDir):
+    """Link the artifacts of stage from the previous release, returns False
+    if any of them is missing"""
+    for artifact in stage.artifacts:
+        if not path.isfile(path.join(previousDir, artifact)):
+            return False
+    for artifact in stage.artifacts:
+        link_or_copy(path.join(previousDir, artifact), path.join(releaseDir, artifact))
+    return True
+
+
+def storeArtifact(storeDir, artifactFile):
+    """Make artifactFile a hard link to the blob of the store with the same
+    content, adding it to the store if there is none. Returns its digest."""
+    digest = file_digest(artifactFile)
+    blob = path.join(storeDir, digest[:2], digest)
+    temp = '.' + str(getpid()) + '.part'
+    try:
+        if not path.exists(blob):
+            makedirs(path.dirname(blob), exist_ok=True)
+            # linked under a temporary name first, blobs are always complete
+            link(artifactFile, blob + temp)
+            # blobs are shared by releases, none of them should change it
+            chmod(blob + temp, 0o444)
+            replace(blob + temp, blob)
+        elif not path.samefile(blob, artifactFile):
+            link(blob, artifactFile + temp)
+            replace(artifactFile + temp, artifactFile)
+    except OSError:
+        # e.g. no hard links on this filesystem, or the blob has just been
+        # collected, the artifact keeps its own copy
+        pass
+    return digest
+
+
+def collectGarbage(outputDir):
+    """Remove the blobs of the store no release folder links to anymore"""
+    storeDir = path.join(outputDir, STORE_DIRECTORY_NAME)
+    removed = 0
+    freed = 0
+    for root, dirs, files in walk(storeDir):
+        for f in files:
+            blob = path.join(root, f)
+            st = stat(blob)
+            # the store's own link is the last one
+            if st.st_nlink == 1:
+                remove(blob)
+                removed += 1
+                freed += st.st_size
+
+    print("Removed " + str(removed) + " unreferenced blobs, " +
+          '{:.1f}'.format(freed / 1e6) + " MB freed")
+
+
+def countFootprints(boardFile):
+    with open(boardFile, 'rb') as f:
+        content = f.read()
+    # KiCad 6 boards use 'footprint', older ones 'module'
+    return content.count(b'(footprint ') + content.count(b'(module ')
+
+
+def isStepComplete(stepFile):
+    # a STEP file is only complete once its trailer has been written
+    with open(stepFile, 'rb') as f:
+        f.seek(max(0, path.getsize(stepFile) - 256))
+        return f.read().rstrip().endswith(STEP_TRAILER)
+
+
 def export_step(pcbFile, outputDir):
-    with PopenContext(['kicad2step', pcbFile + '.kicad_pcb', '-o' + outputDir + '/model']) as kicad2step:
-        time.sleep(5)
-        kicad2step.terminate()
+    stepFile = outputDir + '/model.step'
+    timeout = STEP_TIMEOUT + STEP_TIMEOUT_PER_FOOTPRINT * \
+        countFootprints(pcbFile + KICAD_PCB_EXTENSION)
+
+    with PopenContext(['kicad2step', pcbFile + KICAD_PCB_EXTENSION, '-o' + outputDir + '/model']) as kicad2step:
+        try:
+            # kicad2step keeps its log window open once done, so wait for the
+            # model to be complete rather than for the process to exit
+            wait_for_file(stepFile, timeout, kicad2step, isStepComplete)
+        except RuntimeError:
+            # never leave a truncated model behind
+            if path.exists(stepFile):
+                remove(stepFile)
+            raise
+        finally:
+            if kicad2step.poll() is None:
+                kicad2step.terminate()
 
     print("Exported model.step")
 
 
-def export_gerbers(pcbFile, outputDir, withSilkScreen):
-    board = pcbnew.LoadBoard(pcbFile + KICAD_PCB_EXTENSION)
+@traced('load board')
+def loadBoard(pcbFile):
+    import pcbnew
+    boardFile = pcbFile + KICAD_PCB_EXTENSION
+    if boardCache is None:
+        return pcbnew.LoadBoard(boardFile)
+
+    # reuse the loaded board as long as the file has not been modified
+    mtime = path.getmtime(boardFile)
+    cached = boardCache.pop(boardFile, None)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, pcbnew.LoadBoard(boardFile))
+    boardCache[boardFile] = cached
+    while len(boardCache) > BOARD_CACHE_SIZE:
+        boardCache.pop(next(iter(boardCache)))
+    return cached[1]
+
+
+# user drawing layers plotted when enabled on the board, User_1... only
+# exist since KiCad 6
+USER_LAYERS = ['Dwgs_User', 'Cmts_User', 'Eco1_User', 'Eco2_User'] + \
+    ['User_' + str(i) for i in range(1, 10)]
+
+
+def buildPlotPlan(board, withSilkScreen=True, withPaste=True):
+    """Return the (file suffix, layer, description) of every layer of the
+    board to plot, for any number of copper layers."""
+    import pcbnew
+    enabled = board.GetEnabledLayers().Seq()
+
+    innerLayers = [layer for layer in enabled if pcbnew.IsCopperLayer(layer) and
+                   layer not in (pcbnew.F_Cu, pcbnew.B_Cu)]
+    plotPlan = [("F_Cu", pcbnew.F_Cu, "Top layer")]
+    for i, layer in enumerate(innerLayers, 1):
+        plotPlan.append(("In" + str(i) + "_Cu", layer, "Internal layer " + str(i)))
+    plotPlan += [
+        ("B_Cu", pcbnew.B_Cu, "Bottom layer"),
+        ("F_Mask", pcbnew.F_Mask, "Mask top"),
+        ("B_Mask", pcbnew.B_Mask, "Mask bottom"),
+        ("Edge_Cuts", pcbnew.Edge_Cuts, "Edges"),
+    ]
+    if withSilkScreen:
+        plotPlan += [
+            ("F_Silk", pcbnew.F_SilkS, "Silk top"),
+            ("B_Silk", pcbnew.B_SilkS, "Silk bottom"),
+        ]
+    if withPaste:
+        plotPlan += [
+            ("F_Paste", pcbnew.F_Paste, "Paste top"),
+            ("B_Paste", pcbnew.B_Paste, "Paste Bottom"),
+        ]
+
+    for name in USER_LAYERS:
+        layer = getattr(pcbnew, name, None)
+        if layer is not None and layer in enabled:
+            # named after the board's layer name, users can rename these
+            plotPlan.append((board.GetLayerName(layer).replace('.', '_'), layer,
+                             board.GetLayerName(layer)))
+
+    return plotPlan
 
-    withPaste = True
-    with4layers = board.GetDesignSettings().GetCopperLayerCount() == 4
 
+def _createPlotController(board, plotDir):
+    import pcbnew
     # configure plotter
     pctl = pcbnew.PLOT_CONTROLLER(board)
     popt = pctl.GetPlotOptions()
@@ -92,66 +590,103 @@ def export_gerbers(pcbFile, outputDir, withSilkScreen):
     popt.SetDrillMarksType(pcbnew.PCB_PLOT_PARAMS.NO_DRILL_SHAPE)
     popt.SetSkipPlotNPTH_Pads(True)
 
-    # set plot layers
-    tempdir = tempfile.mkdtemp()
-    popt.SetOutputDirectory(tempdir)
+    popt.SetOutputDirectory(plotDir)
+    return pctl
 
-    plotPlan = [
-        ("F_Cu", pcbnew.F_Cu, "Top layer"),
-        ("B_Cu", pcbnew.B_Cu, "Bottom layer"),
-        ("F_Mask", pcbnew.F_Mask, "Mask top"),
-        ("B_Mask", pcbnew.B_Mask, "Mask bottom"),
-        ("Edge_Cuts", pcbnew.Edge_Cuts, "Edges"),
-    ]
-    if with4layers:
-        plotPlan += [
-            ("In1_Cu", pcbnew.In1_Cu, "Top internal layer"),
-            ("In2_Cu", pcbnew.In2_Cu, "Bottom internal layer"),
-        ]
-    if withSilkScreen:
-        plotPlan += [
-            ("F_Silk", pcbnew.F_SilkS, "Silk top"),
-            ("B_Silk", pcbnew.B_SilkS, "Silk top"),
-        ]
-    if withPaste:
-        plotPlan += [
-            ("F_Paste", pcbnew.F_Paste, "Paste top"),
-            ("B_Paste", pcbnew.B_Paste, "Paste Bottom"),
-        ]
 
+def _plotLayers(board, plotDir, plotPlan, onPlotted=None):
+    """Plot the layers of plotPlan, onPlotted is called with every plot file
+    as soon as it is closed. Returns the plot files."""
+    import pcbnew
+    pctl = _createPlotController(board, plotDir)
+    plotFiles = []
     for layerInfo in plotPlan:
-        pctl.SetLayer(layerInfo[1])
-        pctl.OpenPlotfile(
-            layerInfo[0], pcbnew.PLOT_FORMAT_GERBER, layerInfo[2])
-        pctl.PlotLayer()
-
-    # plot drill files
+        with trace_span('plot layer', target=layerInfo[0]):
+            pctl.SetLayer(layerInfo[1])
+            pctl.OpenPlotfile(
+                layerInfo[0], pcbnew.PLOT_FORMAT_GERBER, layerInfo[2])
+            pctl.PlotLayer()
+            plotFiles.append(pctl.GetPlotFileName())
+            pctl.ClosePlot()
+        if onPlotted is not None:
+            onPlotted(plotFiles[-1])
+    return plotFiles
+
+
+@traced('plot drill')
+def _plotDrill(board, plotDir):
+    """Write the drill and map files, returns them"""
+    import pcbnew
+    # in a directory of their own, the writer doesn't tell their names
+    plotDir = path.join(plotDir, 'drill')
+    mkdir(plotDir)
     drlWriter = pcbnew.EXCELLON_WRITER(board)
     drlWriter.SetMapFileFormat(pcbnew.PLOT_FORMAT_GERBER)
     drlWriter.SetOptions(aMirror=False, aMinimalHeader=False,
                          aOffset=pcbnew.wxPoint(0, 0), aMerge_PTH_NPTH=False)
     drlWriter.SetFormat(True, pcbnew.EXCELLON_WRITER.DECIMAL_FORMAT, 3, 3)
-    drlWriter.CreateDrillandMapFilesSet(pctl.GetPlotDirName(), True, False)
+    drlWriter.CreateDrillandMapFilesSet(plotDir, True, False)
+    return [path.join(plotDir, f) for f in sorted(listdir(plotDir))]
+
+
+def _plotLayersTask(pcbFile, plotDir, plotPlan):
+    # runs in a plotting worker, the board objects can't be shared, returns
+    # the plot files and the spans of the worker
+    return _plotLayers(loadBoard(pcbFile), plotDir, plotPlan), take_trace_events()
 
-    pctl.ClosePlot()
 
-    # zip files
-    files = listdir(tempdir)
-    with zipfile.ZipFile(path.join(tempdir, "zip"), 'w', zipfile.ZIP_DEFLATED) as myzip:
-        for file in files:
-            myzip.write(path.join(tempdir, file), file)
+def _plotDrillTask(pcbFile, plotDir):
+    return _plotDrill(loadBoard(pcbFile), plotDir), take_trace_events()
 
-    shutil.move(path.join(tempdir, "zip"), outputDir + '/gerbers.zip')
 
-    # remove tempdir
-    shutil.rmtree(tempdir)
+def _runPlotTask(task):
+    func, args = task
+    return func(*args)
 
-    print("Exported gerbers.zip")
+
+def export_gerbers(pcbFile, outputDir, withSilkScreen, plotJobs=1,
+                   compression='deflate', compressionLevel=None):
+    board = loadBoard(pcbFile)
+    archiveName = 'gerbers' + archive_extension(compression)
+
+    # set plot layers
+    tempdir = tempfile.mkdtemp()
+    plotPlan = buildPlotPlan(board, withSilkScreen)
+
+    try:
+        # every plot file is compressed as soon as it is closed, straight
+        # into the archive in the release folder
+        with StreamingArchive(outputDir + '/' + archiveName, compression,
+                              compressionLevel) as archive:
+            if plotJobs > 1:
+                # every worker loads the board and plots its share of the
+                # layers, dealt round robin so the copper layers are spread
+                # out, while the drill files are a task of their own
+                tasks = [(_plotLayersTask, (pcbFile, tempdir, plotPlan[i::plotJobs]))
+                         for i in range(min(plotJobs, len(plotPlan)))]
+                tasks.append((_plotDrillTask, (pcbFile, tempdir)))
+                # leaving the pool terminates its workers, a cancelled export
+                # doesn't wait for them before removing tempdir
+                with workerContext.Pool(plotJobs, _initWorker, _workerSettings()) as plotters:
+                    for plotFiles, events in plotters.imap_unordered(_runPlotTask, tasks):
+                        add_trace_events(events)
+                        for plotFile in plotFiles:
+                            archive.add(plotFile)
+            else:
+                _plotLayers(board, tempdir, plotPlan, archive.add)
+                # plot drill files
+                for plotFile in _plotDrill(board, tempdir):
+                    archive.add(plotFile)
+    finally:
+        # remove tempdir
+        shutil.rmtree(tempdir)
+
+    print("Exported " + archiveName)
 
 
 def export_bom(annotationFile, outputDir, projectName):
-    # Generate an instance of a generic netlist
-    net = kicad_netlist_reader.netlist(annotationFile)
+    # Generate an instance of a generic netlist, the BOM doesn't need the nets
+    net = kicad_netlist_reader.netlist(annotationFile, sections={'components', 'libparts'})
 
     # Open a file to write to, if the file cannot be opened output to stdout
     try:
@@ -192,50 +727,649 @@ def export_bom(annotationFile, outputDir, projectName):
                       c.getField("Distributor Code"),
                       c.getField("Distributor")])
 
+    # stages may run in a worker process that exits without flushing
+    f.close()
+
     print("Exported bom.csv")
 
 
-def export_schematic(mainSchFile, outputDir):
-    with PopenContext(['eeschema', mainSchFile]) as eeschema:
+def isPdfComplete(pdfFile):
+    # a PDF file is only complete once its end-of-file marker has been written
+    with open(pdfFile, 'rb') as f:
+        f.seek(max(0, path.getsize(pdfFile) - 1024))
+        return f.read().rstrip().endswith(PDF_TRAILER)
+
+
+def _rootSheetName(mainSchFile):
+    rootName = path.basename(mainSchFile)
+    if rootName.endswith(KICAD_SCH_EXTENSION):
+        rootName = rootName[:-len(KICAD_SCH_EXTENSION)]
+    return rootName
+
+
+def _schematicPdfName(mainSchFile):
+    # eeschema names the plot after the root sheet
+    return _rootSheetName(mainSchFile) + '.pdf'
+
+
+def _schematicInputs(mainSchFile):
+    # the files the schematic fingerprint covers, with their modification
+    # times: sub-sheets, project file and symbol library table
+    return {f: path.getmtime(f) for f in
+            projectFiles(path.dirname(path.abspath(mainSchFile)), SCHEMATIC_INPUTS)}
+
+
+def _plotSchematic(pdfFile, outputDir, display=None):
+    # open plotting window
+    xdotool(['key', 'shift+ctrl+p'], display)
+
+    # search for plotting window and focus it
+    wait_for_window('Plot Schematic Options', display=display)
+
+    # input output directory, then move to plot button by tabbing and
+    # press enter
+    send_keys([('type', outputDir + '/'),
+               ('key',) + ('Tab',) * 18 + ('enter',)],
+              SCHEMATIC_KEY_DELAY, display)
+
+    # wait for eeschema to write and close the whole document
+    wait_for_written_file(pdfFile, SCHEMATIC_PLOT_TIMEOUT, isPdfComplete)
+
+
+class SchematicPlotter():
+    """A warm eeschema instance running on its own Xvfb display, which can
+    plot one schematic after the other without being restarted.
+    """
+
+    def __init__(self, maxJobs):
+        self.maxJobs = maxJobs
+        self.xvfb = None
+        self.display = None
+        self.eeschema = None
+        self.schFile = None
+        self.schInputs = None
+        self.jobs = 0
+
+    def start(self, schFile):
+        if self.xvfb is None:
+            self.xvfb, self.display = start_xvfb()
+        self.eeschema = PopenContext(['eeschema', schFile],
+                                     env=display_env(self.display))
+        try:
+            wait_for_window('Schematic Editor', display=self.display)
+        except Exception:
+            self.stopEeschema()
+            raise
+        self.schFile = schFile
+        self.schInputs = _schematicInputs(schFile)
+        self.jobs = 0
+
+    def stopEeschema(self):
+        if self.eeschema is not None:
+            with self.eeschema:
+                self.eeschema.terminate()
+            self.eeschema = None
+            self.schFile = None
+
+    def stop(self):
+        self.stopEeschema()
+        if self.xvfb is not None:
+            stop_xvfb(self.xvfb)
+            self.xvfb = None
+            self.display = None
+
+    def isHealthy(self):
+        if self.xvfb is None or self.xvfb.proc.poll() is not None:
+            return False
+        if self.eeschema is None or self.eeschema.poll() is not None:
+            return False
+        try:
+            wait_for_window('Schematic Editor', timeout=1, display=self.display)
+        except RuntimeError:
+            return False
+        return True
+
+    def open(self, schFile):
+        # open file dialog, the typed path is picked up by its location bar
+        xdotool(['key', 'ctrl+o'], self.display)
+        wait_for_window('Open Schematic', display=self.display)
+        send_keys([('type', schFile), ('key', 'enter')],
+                  SCHEMATIC_KEY_DELAY, self.display)
+        # the title shows the root sheet without its extension
+        wait_for_window(re.escape(_rootSheetName(schFile)) + '.*Schematic Editor',
+                        display=self.display)
+        self.schFile = schFile
+        self.schInputs = _schematicInputs(schFile)
+
+    def plot(self, mainSchFile, outputDir):
+        if self.jobs >= self.maxJobs or not self.isHealthy():
+            # recycle the instance, it is either worn out or broken
+            if self.xvfb is not None and self.xvfb.proc.poll() is not None:
+                self.stop()
+            self.stopEeschema()
+        if self.eeschema is None or (self.schFile == mainSchFile and
+                                     self.schInputs != _schematicInputs(mainSchFile)):
+            # a changed file on disk is only picked up by a fresh eeschema
+            self.stopEeschema()
+            self.start(mainSchFile)
+        elif self.schFile != mainSchFile:
+            self.open(mainSchFile)
+
+        pdfFile = outputDir + '/' + _schematicPdfName(mainSchFile)
+        try:
+            _plotSchematic(pdfFile, outputDir, self.display)
+        finally:
+            self.jobs += 1
+        # close the plot dialog, back to the schematic editor
+        xdotool(['key', 'Escape'], self.display)
+        return pdfFile
+
+
+class SchematicPlotterPool():
+    """A pool of headless eeschema instances shared by consecutive or
+    concurrent schematic exports. Each instance is health checked before
+    every job and recycled after maxJobs plots.
+    """
+
+    def __init__(self, size=1, maxJobs=SCHEMATIC_PLOTTER_MAX_JOBS):
+        self.plotters = [SchematicPlotter(maxJobs) for i in range(size)]
+        self.idle = queue.Queue()
+        for plotter in self.plotters:
+            self.idle.put(plotter)
+
+    def plot(self, mainSchFile, outputDir):
+        plotter = self.idle.get()
+        try:
+            return plotter.plot(mainSchFile, outputDir)
+        except Exception:
+            # never hand out an instance left in an unknown state
+            plotter.stopEeschema()
+            raise
+        finally:
+            self.idle.put(plotter)
+
+    def close(self):
+        for plotter in self.plotters:
+            plotter.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def export_schematic(mainSchFile, outputDir, schematicPool=None):
+    if schematicPool is not None:
+        pdfFile = schematicPool.plot(mainSchFile, outputDir)
+    else:
+        pdfFile = outputDir + '/' + _schematicPdfName(mainSchFile)
+        with PopenContext(['eeschema', mainSchFile]) as eeschema:
 
-        # search for eeschema window and focus it
-        waitForWindow('Schematic Editor')
+            # search for eeschema window and focus it
+            wait_for_window('Schematic Editor')
 
-        # open plotting window
-        xdotool(['key', 'shift+ctrl+p'])
+            _plotSchematic(pdfFile, outputDir)
+            eeschema.terminate()
 
-        # search for plotting window and focus it
-        waitForWindow('Plot Schematic Options')
+    # rename the just exported schematic
+    rename(pdfFile, outputDir + '/' + 'schematic.pdf')
 
-        # input output directory
-        xdotool(['type', outputDir + '/'])
+    print("Exported schematic.pdf")
 
-        # move to plot button by tabbing and press enter
-        for x in range(1, 19):
-            xdotool(['key', 'Tab'])
-        xdotool(['key', 'enter'])
 
-        # wait for export to take place, 2 seconds should suffice
-        time.sleep(3)
-        eeschema.terminate()
+class ReleaseJob():
+    """A release of a project, from the allocation of its number in the
+    index to the recording of its outcome, see prepareRelease(). stages are
+    the stages left to run, the others reuse the artifacts of a previous
+    release.
+    """
+
+    def __init__(self, indexDir, projectName, releaseNumber, stages,
+                 fingerprints, reused):
+        self.indexDir = indexDir
+        self.name = projectName + '_release_' + str(releaseNumber)
+        self.outputDir = indexDir + '/' + self.name
+        self.releaseNumber = releaseNumber
+        self.stages = stages
+        self.fingerprints = fingerprints
+        self.reused = reused
+        self.start = time.monotonic()
+        self.duration = None
+        self.error = None
+
+    def finish(self, error=None):
+        """Record the outcome of the release in the index, the artifacts of a
+        complete release are added to the store"""
+        artifacts = {}
+        if error is None:
+            try:
+                # identical artifacts of all releases share a single blob
+                storeDir = self.indexDir + '/' + STORE_DIRECTORY_NAME
+                with trace_span('store artifacts', target=self.name):
+                    for artifact in sorted(listdir(self.outputDir)):
+                        if not artifact.startswith('.'):
+                            artifacts[artifact] = storeArtifact(
+                                storeDir, path.join(self.outputDir, artifact))
+            except Exception as e:
+                error = e
+
+        with releaseIndex(self.indexDir) as index:
+            entry = index['releases'][str(self.releaseNumber)]
+            if error is None:
+                entry.update(status='complete', finished=timestamp(),
+                             fingerprints=self.fingerprints, artifacts=artifacts)
+            else:
+                entry.update(status='failed', finished=timestamp())
+
+        self.error = error
+        self.duration = time.monotonic() - self.start
+        trace_event(self.name, self.start, self.duration,
+                    complete=error is None, reused=self.reused)
+
+    def printTimings(self):
+        for name in self.reused:
+            print('  {:<10} reused'.format(name))
+        for stage in self.stages:
+            print('  {:<10} {:6.2f}s'.format(stage.name, stage.duration))
+        print("Finished exporting '" + self.name + "' in " +
+              '{:.2f}s'.format(self.duration))
+
+
+@traced('prepare release')
+def prepareRelease(projectDir, schFile, pcbFile, projectName='', withSilkScreen=True,
+                   schematicPool=None, plotJobs=1, compression='deflate',
+                   compressionLevel=None, full=False):
+    """Allocate the next release of the project in projectDir and reuse the
+    artifacts of the stages whose inputs are unchanged, returns the
+    ReleaseJob with the stages left to run"""
+    outputDir = projectDir + '/' + RELEASE_DIRECTORY_NAME
+    schFile = projectDir + '/' + schFile
+    pcbFile = projectDir + '/' + pcbFile
 
-    # rename the just exported schematic
-    for f in listdir(outputDir):
-        if '.pdf' in f:
-            rename(outputDir + '/' + f, outputDir + '/' + 'schematic.pdf')
+    schAnnotated = False
+    for f in listdir(projectDir):
+        if '.xml' in f:
+            schAnnotated = True
             break
+    if not schAnnotated:
+        print("Generating BOM requires a fully annotated schematic. Missing .xml file.")
+        exit(1)
 
-    print("Exported schematic.pdf")
+    checkForOutputFolder(outputDir)
+    with releaseIndex(outputDir) as index:
+        projectName = getProjectName(index, projectName)
+        releaseNumber = getReleaseNumber(index, outputDir)
+        previousDir, previous = previousRelease(index, outputDir, releaseNumber)
+        mkdir(outputDir + '/' + projectName + '_release_' + str(releaseNumber))
+        index['releases'][str(releaseNumber)] = {
+            'name': projectName + '_release_' + str(releaseNumber),
+            'status': 'running',
+            'started': timestamp(),
+        }
 
+    # update var with projectName and releaseNumber
+    indexDir = outputDir
+    outputDir = outputDir + '/' + projectName + \
+        '_release_' + str(releaseNumber)
 
-if __name__ == '__main__':
+    print("Exporting '" + projectName +
+          '_release_' + str(releaseNumber) + "' ...")
 
-    schFile = ''
-    pcbFile = ''
-    projectName = ''
-    cwd = getcwd()
-    outputDir = cwd + '/' + RELEASE_DIRECTORY_NAME
+    stages = [
+        ReleaseStage('schematic', export_schematic,
+                     (schFile, outputDir, schematicPool),
+                     artifacts=('schematic.pdf',), resource='gui'),
+        # without a pool eeschema is typed into on the user's display, where
+        # the kicad2step window could take the keyboard focus
+        ReleaseStage('step', export_step, (pcbFile, outputDir),
+                     artifacts=('model.step',),
+                     resource='cpu' if schematicPool is not None else 'gui'),
+        ReleaseStage('bom', export_bom, (schFile + '.xml', outputDir, projectName),
+                     inProcess=True, artifacts=('bom.csv',), resource='cpu'),
+        ReleaseStage('gerbers', export_gerbers,
+                     (pcbFile, outputDir, withSilkScreen, plotJobs,
+                      compression, compressionLevel), inProcess=True,
+                     artifacts=('gerbers' + archive_extension(compression),),
+                     resource='cpu'),
+    ]
+    for stage in stages:
+        # unique even for projects sharing a name and release number
+        stage.group = path.abspath(outputDir)
+
+    # a stage whose inputs are the same as for the previous release links its
+    # artifacts from there rather than exporting them again
+    fingerprints = {
+        'schematic': stageFingerprint(projectDir, 'schematic',
+                                      projectFiles(projectDir, SCHEMATIC_INPUTS), {}),
+        'step': stageFingerprint(projectDir, 'step', [pcbFile + KICAD_PCB_EXTENSION], {}),
+        'bom': stageFingerprint(projectDir, 'bom', [schFile + '.xml'],
+                                {'projectName': projectName}),
+        'gerbers': stageFingerprint(projectDir, 'gerbers', [pcbFile + KICAD_PCB_EXTENSION],
+                                    {'silkscreen': withSilkScreen,
+                                     'compression': compression,
+                                     'compressionLevel': compressionLevel}),
+    }
+    if full:
+        previous = {}
+    reused = []
+    for stage in stages:
+        if previous.get(stage.name) == fingerprints[stage.name] and \
+                reuseArtifacts(stage, previousDir, outputDir):
+            print("Reused " + ', '.join(stage.artifacts) + " of '" +
+                  path.basename(previousDir) + "'")
+            reused.append(stage.name)
+
+    return ReleaseJob(indexDir, projectName, releaseNumber,
+                      [stage for stage in stages if stage.name not in reused],
+                      fingerprints, reused)
+
+
+def release(projectDir, schFile, pcbFile, projectName='', withSilkScreen=True,
+            schematicPool=None, useProcesses=True, plotJobs=1,
+            compression='deflate', compressionLevel=None, full=False):
+    job = prepareRelease(projectDir, schFile, pcbFile, projectName, withSilkScreen,
+                         schematicPool, plotJobs, compression, compressionLevel, full)
+    try:
+        if job.stages:
+            runStages(job.stages, useProcesses, {'gui': 1})
+    except BaseException as e:
+        job.finish(e)
+        raise
+    job.finish()
+    if job.error is not None:
+        raise job.error
+
+    job.printTimings()
+
+
+# options of the projects of a batch file, also allowed at its top level as
+# defaults for all of them
+BATCH_OPTIONS = ('dir', 'sch', 'pcb', 'name', 'no-silk', 'plot-jobs',
+                 'compression', 'compression-level', 'full')
+
+
+def loadBatch(batchFile):
+    """Read the projects of a batch file, a TOML file with a [[project]]
+    table per project. Returns their options, with the defaults of the top
+    level applied and 'dir' made absolute."""
+    if tomllib is None:
+        raise RuntimeError("Batch files need Python 3.11 or the 'tomli' module")
+    with open(batchFile, 'rb') as f:
+        config = tomllib.load(f)
+
+    # project folders are relative to the batch file
+    baseDir = path.dirname(path.abspath(batchFile))
+    defaults = {key: value for key, value in config.items() if key != 'project'}
+    projects = []
+    for i, project in enumerate(config.get('project', []), 1):
+        options = dict(defaults)
+        options.update(project)
+        unknown = [key for key in options if key not in BATCH_OPTIONS]
+        if unknown:
+            raise RuntimeError("Unknown option '" + unknown[0] + "' for project " +
+                               str(i) + " of '" + batchFile + "'")
+        for key in ('dir', 'sch', 'pcb'):
+            if key not in options:
+                raise RuntimeError("Project " + str(i) + " of '" + batchFile +
+                                   "' has no '" + key + "'")
+        if options.get('compression', 'deflate') not in ARCHIVE_FORMATS:
+            raise RuntimeError("Unknown compression for project " + str(i) +
+                               ", must be one of: " + ', '.join(ARCHIVE_FORMATS))
+        options['dir'] = path.normpath(path.join(baseDir, options['dir']))
+        projects.append(options)
+    return projects
+
+
+def _errorSummary(error):
+    # errors of worker processes carry their whole traceback
+    if isinstance(error, SystemExit):
+        return 'stopped, see above'
+    lines = str(error).strip().splitlines()
+    if not lines:
+        return type(error).__name__
+    return lines[-1] if lines[0].startswith('Traceback') else lines[0]
+
+
+def printBatchSummary(jobs, failures, duration):
+    print("\nBatch summary:")
+    for job in jobs:
+        stages = [name + ' reused' for name in job.reused]
+        for stage in job.stages:
+            if stage.error is not None or stage.duration is None:
+                stages.append(stage.name + ' failed')
+            else:
+                stages.append(stage.name + ' {:.2f}s'.format(stage.duration))
+        print('  {:<32} {:<7} {}'.format(job.name, 'failed' if job.error else 'ok',
+                                         ', '.join(stages)))
+        if job.error is not None:
+            print('    ' + _errorSummary(job.error))
+    for projectDir, error in failures:
+        print('  {:<32} {:<7} {}'.format(path.basename(projectDir), 'failed',
+                                         _errorSummary(error)))
+
+    released = len([job for job in jobs if job.error is None])
+    print("Released " + str(released) + " of " + str(len(jobs) + len(failures)) +
+          " projects in " + '{:.2f}s'.format(duration))
+
+
+def batch(batchFile, guiJobs=1, cpuJobs=None, headless=False, full=False,
+          useProcesses=True):
+    """Release all the projects of a batch file. Their stages are scheduled
+    together: at most guiJobs stages using a display and cpuJobs stages
+    plotting or exporting run at the same time. A failing project doesn't
+    stop the others. Returns the number of projects which failed."""
+    projects = loadBatch(batchFile)
+    start = time.monotonic()
+
+    if headless:
+        # a warm eeschema on its own display for every schematic at a time
+        schematicPool = SchematicPlotterPool(guiJobs)
+    else:
+        # eeschema is driven through the keyboard focus of the display
+        schematicPool = None
+        guiJobs = 1
+    limits = {'gui': guiJobs, 'cpu': cpuJobs or cpu_count() or 1}
+
+    jobs = []
+    failures = []
+    try:
+        for project in projects:
+            try:
+                jobs.append(prepareRelease(
+                    project['dir'], project['sch'], project['pcb'],
+                    project.get('name', ''), not project.get('no-silk', False),
+                    schematicPool, project.get('plot-jobs', 1),
+                    project.get('compression', 'deflate'),
+                    project.get('compression-level'),
+                    full or project.get('full', False)))
+            except (Exception, SystemExit) as e:
+                failures.append((project['dir'], e))
+
+        stages = [stage for job in jobs for stage in job.stages]
+        try:
+            if stages:
+                runStages(stages, useProcesses, limits, failFast=False)
+        except BaseException as e:
+            for job in jobs:
+                job.finish(e)
+            raise
+
+        for job in jobs:
+            errors = [stage.error for stage in job.stages if stage.error is not None]
+            job.finish(errors[0] if errors else None)
+    finally:
+        if schematicPool is not None:
+            schematicPool.close()
+
+    printBatchSummary(jobs, failures, time.monotonic() - start)
+    return len(failures) + len([job for job in jobs if job.error is not None])
+
+
+def getOption(argv, name, default=None):
+    # options taking a value are given as --name=value
+    for a in argv:
+        if a.startswith(name + '='):
+            return a[len(name) + 1:]
+    return default
+
+
+@contextlib.contextmanager
+def tracingFromArgs(cwd, argv):
+    """Trace the block to the Chrome trace file given by --trace=<file> and
+    profile the in-process stages into the folder given by --profile=<dir>"""
+    global profileDir
+    traceFile = getOption(argv, '--trace')
+    profile = getOption(argv, '--profile')
+
+    if traceFile is not None:
+        start_tracing()
+        trace_name('kirelease')
+        kicad_netlist_reader.tracer = trace_span
+    if profile is not None:
+        profileDir = path.join(cwd, profile)
+        makedirs(profileDir, exist_ok=True)
+
+    try:
+        yield
+    finally:
+        profileDir = None
+        if traceFile is not None:
+            kicad_netlist_reader.tracer = None
+            stop_tracing().write(path.join(cwd, traceFile))
+            print("Trace written to " + traceFile)
+
+
+def releaseFromArgs(cwd, argv, schematicPool=None, useProcesses=True):
+    args = [a for a in argv if not a.startswith('--')]
+    if len(args) < 2:
+        print("Missing arguemnts, use 'kirelease help' for a guide")
+        exit(0)
 
+    compression = getOption(argv, '--compression', 'deflate')
+    if compression not in ARCHIVE_FORMATS:
+        print("Unknown --compression, must be one of: " + ', '.join(ARCHIVE_FORMATS))
+        exit(1)
+    compressionLevel = getOption(argv, '--compression-level')
+
+    with tracingFromArgs(cwd, argv):
+        release(cwd, args[0], args[1],
+                args[2] if len(args) >= 3 else '',
+                False if '--no-silk' in argv else True,
+                schematicPool, useProcesses,
+                int(getOption(argv, '--plot-jobs', '1')),
+                compression,
+                None if compressionLevel is None else int(compressionLevel),
+                '--full' in argv)
+
+
+def daemonSocketPath():
+    runtimeDir = environ.get('XDG_RUNTIME_DIR')
+    if runtimeDir:
+        return runtimeDir + '/kirelease.sock'
+    return '/tmp/kirelease-' + str(getuid()) + '.sock'
+
+
+class _JobOutput():
+    """File-like object forwarding the output of a release to the client"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        if text:
+            self.send({'out': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def send(self, message):
+        with self.lock:
+            self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _ReleaseJobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # a connection without a job, e.g. a daemon checking the socket
+            return
+        job = json.loads(line)
+        output = _JobOutput(self.wfile)
+        exitCode = 0
+        with contextlib.redirect_stdout(output):
+            try:
+                # in-process stages run in threads to use the loaded boards
+                releaseFromArgs(job['cwd'], job['args'],
+                                self.server.schematicPool, useProcesses=False)
+            except SystemExit as e:
+                exitCode = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print("Release failed: " + str(e))
+                exitCode = 1
+        output.send({'exit': exitCode})
+
+
+def serve(socketPath):
+    """Run the release daemon: keeps pcbnew imported, the loaded boards and
+    a warm headless eeschema around, and runs the release jobs submitted on
+    socketPath one at a time."""
+    global boardCache
+    boardCache = {}
+    # imported once for all the releases, the clients never import it
+    import pcbnew
+
+    if path.exists(socketPath):
+        # left behind by a daemon that died, unless one still listens on it
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socketPath)
+            except ConnectionRefusedError:
+                remove(socketPath)
+            else:
+                print("A kirelease daemon is already listening on " + socketPath)
+                exit(1)
+    # created private, other users must not submit releases
+    oldUmask = umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(socketPath, _ReleaseJobHandler)
+    finally:
+        umask(oldUmask)
+    server.schematicPool = SchematicPlotterPool()
+    print("kirelease daemon listening on " + socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.schematicPool.close()
+        remove(socketPath)
+
+
+def submitRelease(socketPath, cwd, argv):
+    """Submit a release to a running daemon and print its output, returns
+    the exit code of the release"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        stream = sock.makefile('rwb')
+        stream.write(json.dumps({'cwd': cwd, 'args': argv}).encode('utf-8') + b'\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'exit' in message:
+                return message['exit']
+    print("kirelease daemon closed the connection")
+    return 1
+
+
+def main():
     if (len(sys.argv) == 1):
         print("Missing arguemnts, use 'kirelease help' for a guide")
         exit(0)
@@ -246,40 +1380,74 @@ if __name__ == '__main__':
               "<schFile> is the root .kicad_sch file in the schematic hirearchy\n"
               "<pcbFile> is the .kicad_pcb file\n"
               "<projectName> is the name for the output files, only needed for first release\n"
-              "--no-silk to not plot the silkscreen\n\n"
+              "--no-silk to not plot the silkscreen\n"
+              "--headless to run eeschema on its own Xvfb display\n"
+              "--plot-jobs=<n> to plot the gerber layers with n worker processes\n"
+              "--compression=<format> for the gerbers archive: deflate (default), store,\n"
+              "  parallel-deflate or zstd (gerbers.tar.zst)\n"
+              "--compression-level=<n> to set the compression level\n"
+              "--full to export everything again, even what is unchanged since\n"
+              "  the previous release\n"
+              "--trace=<file> to write a Chrome trace (chrome://tracing, Perfetto) of\n"
+              "  the stages and their steps\n"
+              "--profile=<dir> to write a cProfile .pstats file for every pcbnew stage\n"
+              "--daemon to submit the release to a running 'kirelease serve'\n\n"
+              "kirelease batch <projects.toml>\n\n"
+              "releases every project of a batch file, a [[project]] table for each with\n"
+              "dir, sch, pcb and optionally name, no-silk, plot-jobs, compression,\n"
+              "compression-level and full. Options at the top level apply to all projects.\n"
+              "--gui-jobs=<n> eeschema instances, only with --headless (1)\n"
+              "--cpu-jobs=<n> plotting and export stages at the same time (cpu count)\n"
+              "--headless, --full, --trace and --profile as above\n\n"
+              "kirelease gc\n\n"
+              "removes the stored files no release uses anymore, once release folders\n"
+              "have been deleted.\n\n"
+              "kirelease serve [socket]\n\n"
+              "starts a daemon keeping pcbnew, the loaded boards and eeschema around\n"
+              "between releases.\n\n"
               "If a 'release' folder is not present, one will be created.")
         exit(0)
 
-    schFile = cwd + '/' + sys.argv[1]
-    pcbFile = cwd + '/' + sys.argv[2]
-
-    checkForOutputFolder(outputDir)
-    projectName = getProjectName(outputDir)
-    releaseNumber = getReleaseNumber(outputDir)
-
-    # update var with projectName and releaseNumber
-    outputDir = outputDir + '/' + projectName + \
-        '_release_' + str(releaseNumber)
+    if (sys.argv[1] == 'batch'):
+        if len(sys.argv) < 3 or sys.argv[2].startswith('--'):
+            print("Missing <projects.toml>, use 'kirelease help' for a guide")
+            exit(0)
+        cpuJobs = getOption(sys.argv, '--cpu-jobs')
+        try:
+            with tracingFromArgs(getcwd(), sys.argv):
+                failed = batch(sys.argv[2], int(getOption(sys.argv, '--gui-jobs', '1')),
+                               None if cpuJobs is None else int(cpuJobs),
+                               '--headless' in sys.argv, '--full' in sys.argv)
+        except Exception as e:
+            print("Batch failed: " + str(e))
+            exit(1)
+        exit(1 if failed else 0)
+
+    if (sys.argv[1] == 'gc'):
+        collectGarbage(getcwd() + '/' + RELEASE_DIRECTORY_NAME)
+        exit(0)
 
-    print("Exporting '" + projectName +
-          '_release_' + str(releaseNumber) + "' ...")
+    if (sys.argv[1] == 'serve'):
+        serve(sys.argv[2] if len(sys.argv) >= 3 else daemonSocketPath())
+        exit(0)
 
-    export_schematic(schFile, outputDir)
-    export_step(pcbFile, outputDir)
+    if '--daemon' in sys.argv:
+        argv = [a for a in sys.argv[1:] if a != '--daemon']
+        try:
+            exit(submitRelease(daemonSocketPath(), getcwd(), argv))
+        except (ConnectionRefusedError, FileNotFoundError):
+            print("kirelease daemon is not running, releasing locally.")
 
-    schAnnotated = False
-    for f in listdir(cwd):
-        if '.xml' in f:
-            schAnnotated = True
-            break
-    if schAnnotated:
-        export_bom(schFile + '.xml', outputDir, projectName)
-    else:
-        print("Generating BOM requires a fully annotated schematic. Missing .xml file.")
+    schematicPool = SchematicPlotterPool() if '--headless' in sys.argv else None
+    try:
+        releaseFromArgs(getcwd(), sys.argv[1:], schematicPool)
+    except Exception as e:
+        print("Release failed: " + str(e))
         exit(1)
+    finally:
+        if schematicPool is not None:
+            schematicPool.close()
 
-    export_gerbers(pcbFile, outputDir,
-                   False if '--no-silk' in sys.argv else True)
 
-    print("Finished exporting '" + projectName +
-          '_release_' + str(releaseNumber) + "'")
+if __name__ == '__main__':
+    main()
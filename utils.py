@@ -15,12 +15,204 @@
 #   limitations under the License.
 
 from xvfbwrapper import Xvfb
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import ctypes.util
 import subprocess
+import functools
+import hashlib
+import json
+import shutil
+import fcntl
+import threading
+import zipfile
+import tarfile
+import select
+import ctypes
+import struct
+import queue
 import time
+import zlib
+import os
+import re
+
+try:
+    from Xlib import X, XK
+    from Xlib import display as xdisplay
+    from Xlib.error import XError
+    from Xlib.ext import xtest
+except ImportError:
+    xdisplay = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# children started through PopenContext that are still running, so that a
+# failing release can stop every external tool it launched
+_live_children = set()
+_live_children_lock = threading.Lock()
+_cancelled = threading.Event()
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+
+class Tracer():
+    """Collects spans of work in the Chrome trace event format, which
+    chrome://tracing and Perfetto show as a timeline. Spans are recorded with
+    the process and thread they ran in, forked workers hand theirs over to
+    the parent with take_trace_events()/add_trace_events().
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def add(self, name, start, duration, tid=None, **args):
+        # timestamps of the monotonic clock, the same in every process
+        self.events.append({
+            'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id() if tid is None else tid,
+            'args': args,
+        })
+
+    def name(self, name, tid=None):
+        """Name the current process, or its thread tid, in the timeline"""
+        self.events.append({
+            'name': 'process_name' if tid is None else 'thread_name', 'ph': 'M',
+            'pid': os.getpid(), 'tid': 0 if tid is None else tid,
+            'args': {'name': name},
+        })
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.monotonic()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic() - start,
+                     cpu=round(time.thread_time() - cpu, 6), **args)
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+# the Tracer of the current release, None when it is not traced
+_tracer = None
+
+
+def start_tracing():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing():
+    """Stop tracing, returns the Tracer with the spans recorded"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def tracing():
+    """Return whether spans are being recorded"""
+    return _tracer is not None
+
+
+def trace_span(name, **args):
+    """Return a context manager recording a span when tracing"""
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.span(name, **args)
+
+
+def trace_event(name, start, duration, tid=None, **args):
+    if _tracer is not None:
+        _tracer.add(name, start, duration, tid, **args)
+
+
+def trace_name(name, tid=None):
+    if _tracer is not None:
+        _tracer.name(name, tid)
+
+
+def take_trace_events():
+    """Return and forget the spans recorded so far, used by workers to hand
+    theirs over to the parent"""
+    if _tracer is None:
+        return []
+    events = _tracer.events
+    _tracer.events = []
+    return events
+
+
+def _forget_parent_trace_events():
+    # a forked worker only reports its own spans
+    if _tracer is not None:
+        _tracer.events = []
+
+
+os.register_at_fork(after_in_child=_forget_parent_trace_events)
+
+
+def add_trace_events(events):
+    if _tracer is not None:
+        _tracer.events.extend(events)
+
+
+def traced(name):
+    """Decorator recording every call of the function as a span, along with
+    its first argument"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(name, target=str(args[0])[:200] if args else ''):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 class PopenContext(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        self.started = time.monotonic()
+        # resource usage of the child once it has exited, see os.wait4()
+        self.rusage = None
+        super().__init__(*args, **kwargs)
+        with _live_children_lock:
+            _live_children.add(self)
+        if _cancelled.is_set():
+            self.terminate()
+
+    def _reap(self):
+        # wait for the child with os.wait4() rather than wait(), for its
+        # resource usage, unless poll() already reaped it
+        if self.returncode is not None:
+            return
+        try:
+            pid, status, self.rusage = os.wait4(self.pid, 0)
+        except ChildProcessError:
+            return
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
     def __enter__(self):
         return self
 
@@ -34,20 +226,595 @@ class PopenContext(subprocess.Popen):
         if type:
             self.terminate()
         # Wait for the process to terminate, to avoid zombies.
+        self._reap()
         self.wait()
+        with _live_children_lock:
+            _live_children.discard(self)
+
+        if _tracer is not None:
+            # on a row of its own, the child's cpu time is not ours
+            name = os.path.basename(str(self.args[0] if isinstance(self.args, (list, tuple))
+                                        else self.args))
+            args = {'returncode': self.returncode}
+            if self.rusage is not None:
+                args.update(user=self.rusage.ru_utime, system=self.rusage.ru_stime,
+                            maxrss_kb=self.rusage.ru_maxrss)
+            _tracer.name(name + ' ' + str(self.pid), self.pid)
+            _tracer.add(name, self.started, time.monotonic() - self.started,
+                        self.pid, **args)
+
+
+def terminate_children():
+    """Terminate every running PopenContext child and make the wait helpers
+    give up, used to cancel the stages of a failed release."""
+    _cancelled.set()
+    with _live_children_lock:
+        children = list(_live_children)
+    for child in children:
+        if child.poll() is None:
+            child.terminate()
+
+
+def reset_cancellation():
+    _cancelled.clear()
+
+
+def check_cancelled():
+    if _cancelled.is_set():
+        raise RuntimeError('Release cancelled')
+
+
+def display_env(display=None):
+    """Return the environment for a child process running on display, None
+    to inherit the current one"""
+    if display is None:
+        return None
+    env = dict(os.environ)
+    env['DISPLAY'] = display
+    return env
+
+
+# Xvfb.start()/stop() overwrite DISPLAY in os.environ, which must not leak
+# into the other displays handled by this process
+_xvfb_lock = threading.Lock()
 
 
-def xdotool(command):
-    return subprocess.check_output(['xdotool'] + command)
+@traced('start Xvfb')
+def start_xvfb(width=1920, height=1080):
+    """Start a headless X server, returns (xvfb, display name)"""
+    with _xvfb_lock:
+        previous = os.environ.get('DISPLAY')
+        xvfb = Xvfb(width=width, height=height)
+        try:
+            xvfb.start()
+        finally:
+            if previous is None:
+                os.environ.pop('DISPLAY', None)
+            else:
+                os.environ['DISPLAY'] = previous
+    return xvfb, ':%d' % xvfb.new_display
 
 
-def wait_for_window(window_regex, timeout=10):
-    DELAY = 0.5
-    for i in range(int(timeout/DELAY)):
+def stop_xvfb(xvfb):
+    with _xvfb_lock:
+        previous = os.environ.get('DISPLAY')
         try:
-            xdotool(['search', '--name', window_regex])
+            xvfb.stop()
+        finally:
+            if previous is None:
+                os.environ.pop('DISPLAY', None)
+            else:
+                os.environ['DISPLAY'] = previous
+
+
+def xdotool(command, display=None):
+    return subprocess.check_output(['xdotool'] + command, env=display_env(display))
+
+
+# key names accepted by xdotool that are not X keysym names
+_KEY_ALIASES = {
+    'enter': 'Return',
+    'ctrl': 'Control_L',
+    'control': 'Control_L',
+    'shift': 'Shift_L',
+    'alt': 'Alt_L',
+    'meta': 'Meta_L',
+    'super': 'Super_L',
+}
+
+
+def _xlib_keycode(disp, keysym):
+    """Return (keycode, shifted) for keysym, or None if it is not mapped to
+    a key alone or with Shift"""
+    keycode = disp.keysym_to_keycode(keysym)
+    if keycode == 0:
+        return None
+    if disp.keycode_to_keysym(keycode, 0) == keysym:
+        return keycode, False
+    if disp.keycode_to_keysym(keycode, 1) == keysym:
+        return keycode, True
+    # AltGr or another modifier, xdotool remaps a spare keycode instead
+    return None
+
+
+def _xlib_strokes(disp, steps):
+    """Resolve the script into a list of keycode chords, None if any key
+    cannot be typed with the current keyboard mapping"""
+    shift = _xlib_keycode(disp, XK.string_to_keysym('Shift_L'))
+    strokes = []
+    for step in steps:
+        if step[0] == 'type':
+            for char in step[1]:
+                if char == '\n':
+                    keysym = XK.string_to_keysym('Return')
+                elif char == '\t':
+                    keysym = XK.string_to_keysym('Tab')
+                elif 0x20 <= ord(char) <= 0xff:
+                    # latin-1 keysyms are the character codes
+                    keysym = ord(char)
+                else:
+                    keysym = 0x01000000 | ord(char)
+                key = _xlib_keycode(disp, keysym)
+                if key is None or shift is None:
+                    return None
+                strokes.append([shift[0], key[0]] if key[1] else [key[0]])
+        else:
+            for combo in step[1:]:
+                chord = []
+                for name in combo.split('+'):
+                    name = _KEY_ALIASES.get(name.lower(), name)
+                    keysym = XK.string_to_keysym(name) or \
+                        XK.string_to_keysym(name.capitalize())
+                    key = _xlib_keycode(disp, keysym) if keysym else None
+                    if key is None:
+                        return None
+                    chord.append(key[0])
+                strokes.append(chord)
+    return strokes
+
+
+def _xlib_send_keys(steps, delay, display):
+    disp = xdisplay.Display(display)
+    try:
+        strokes = _xlib_strokes(disp, steps)
+        if strokes is None:
+            return False
+        for chord in strokes:
+            for keycode in chord:
+                xtest.fake_input(disp, X.KeyPress, keycode)
+            for keycode in reversed(chord):
+                xtest.fake_input(disp, X.KeyRelease, keycode)
+            disp.sync()
+            time.sleep(delay / 1000.0)
+        return True
+    finally:
+        disp.close()
+
+
+@traced('send keys')
+def send_keys(steps, delay=12, display=None):
+    """Send a whole keystroke script to the focused window.
+
+    steps is a list of ('type', text) and ('key', key, ...) tuples, keys use
+    the xdotool syntax ('Tab', 'shift+ctrl+p'). delay is the time between
+    keystrokes in milliseconds.
+
+    With python-xlib the keystrokes go through the XTEST extension on a
+    single X connection, otherwise the steps are chained into as few xdotool
+    invocations as possible ('type' takes all the remaining arguments, so it
+    always ends a chain). display selects the X display, the current one by
+    default.
+    """
+    if xdisplay is not None and _xlib_send_keys(steps, delay, display):
+        return
+
+    command = []
+    for step in steps:
+        if step[0] not in ('type', 'key'):
+            raise ValueError('Unknown keystroke step %s' % step[0])
+        command += [step[0], '--delay', str(delay)] + list(step[1:])
+        if step[0] == 'type':
+            xdotool(command, display)
+            command = []
+    if command:
+        xdotool(command, display)
+
+
+def _xlib_window_name(disp, window):
+    try:
+        prop = window.get_full_property(disp.intern_atom('_NET_WM_NAME'),
+                                        disp.intern_atom('UTF8_STRING'))
+        if prop and prop.value:
+            value = prop.value
+            return value.decode('utf-8', 'replace') if isinstance(value, bytes) else str(value)
+        return window.get_wm_name()
+    except XError:
+        # the window was destroyed in the meantime
+        return None
+
+
+def _xlib_wait_for_window(pattern, deadline, display):
+    disp = xdisplay.Display(display)
+    try:
+        def watch(window):
+            # get notified of new children, mappings and title changes
+            try:
+                window.change_attributes(
+                    event_mask=X.SubstructureNotifyMask | X.PropertyChangeMask)
+            except XError:
+                pass
+
+        def matches(window):
+            name = _xlib_window_name(disp, window)
+            return name is not None and pattern.search(name) is not None
+
+        # subscribe first, then look at the existing windows, so that a
+        # window created in between is not missed
+        pending = [disp.screen().root]
+        while pending:
+            window = pending.pop()
+            watch(window)
+            if matches(window):
+                return
+            try:
+                pending.extend(window.query_tree().children)
+            except XError:
+                pass
+
+        while True:
+            while disp.pending_events():
+                event = disp.next_event()
+                if event.type == X.CreateNotify:
+                    watch(event.window)
+                if event.type in (X.CreateNotify, X.MapNotify, X.PropertyNotify):
+                    if matches(event.window):
+                        return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError('Timed out waiting for %s window' % pattern.pattern)
+            check_cancelled()
+            select.select([disp], [], [], min(remaining, 0.5))
+    finally:
+        disp.close()
+
+
+def _xdotool_wait_for_window(window_regex, deadline, display):
+    # a single xdotool blocking until the window shows up, instead of a new
+    # process for every poll
+    with PopenContext(['xdotool', 'search', '--sync', '--name', window_regex],
+                      stdout=subprocess.DEVNULL, env=display_env(display)) as search:
+        while True:
+            check_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                search.terminate()
+                raise RuntimeError('Timed out waiting for %s window' % window_regex)
+            try:
+                returncode = search.wait(min(remaining, 0.5))
+            except subprocess.TimeoutExpired:
+                continue
+            if returncode != 0:
+                raise RuntimeError('xdotool failed waiting for %s window' % window_regex)
             return
-        except subprocess.CalledProcessError:
-            pass
+
+
+@traced('wait for window')
+def wait_for_window(window_regex, timeout=10, display=None):
+    """Block until a window whose name matches window_regex exists.
+
+    Uses X11 events through python-xlib when it is installed, otherwise a
+    single long-lived 'xdotool search --sync'. Returns the time waited in
+    seconds, traced runs record it as a span.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    if xdisplay is not None:
+        # xdotool matches window names case-insensitively
+        _xlib_wait_for_window(re.compile(window_regex, re.IGNORECASE),
+                              deadline, display)
+    else:
+        _xdotool_wait_for_window(window_regex, deadline, display)
+
+    return time.monotonic() - start
+
+
+@traced('wait for file')
+def wait_for_file(filename, timeout, process=None, validator=None, settle=1.0):
+    """Wait until filename is complete: it exists, its size has not changed
+    for settle seconds and validator (if given) accepts it.
+
+    If process exits before that, the file gets a last check instead of
+    waiting for the whole timeout. Raises RuntimeError if the file is not
+    complete in time.
+    """
+    DELAY = 0.2
+    deadline = time.monotonic() + timeout
+    lastSize = -1
+    stableSince = None
+
+    while True:
+        check_cancelled()
+        exited = process is not None and process.poll() is not None
+        now = time.monotonic()
+
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = -1
+
+        if size != lastSize:
+            lastSize = size
+            stableSince = now
+        elif size >= 0 and (exited or now - stableSince >= settle):
+            if validator is None or validator(filename):
+                return
+
+        if exited and (size < 0 or now - stableSince >= settle):
+            raise RuntimeError('%s exited without completing %s' %
+                               (process.args[0], filename))
+        if now > deadline:
+            raise RuntimeError('Timed out waiting for %s' % filename)
         time.sleep(DELAY)
-    raise RuntimeError('Timed out waiting for %s window' % window_regex)
+
+
+def _inotify_watch(directory, mask):
+    """Return an inotify file descriptor watching directory, None when
+    inotify is not available"""
+    if _libc is None:
+        return None
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if _libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _inotify_names(fd):
+    """Return the file names of the pending inotify events"""
+    names = []
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+        offset += _INOTIFY_EVENT.size
+        names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+        offset += length
+    return names
+
+
+@traced('wait for written file')
+def wait_for_written_file(filename, timeout, validator=None):
+    """Wait until filename has been written and closed, and validator (if
+    given) accepts it.
+
+    Uses inotify IN_CLOSE_WRITE events on the parent directory, so it returns
+    as soon as the writer closes the file. Falls back to polling with
+    wait_for_file when inotify is not available.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    fd = _inotify_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+    if fd is None:
+        return wait_for_file(filename, timeout, validator=validator)
+
+    def complete():
+        return os.path.exists(filename) and (validator is None or validator(filename))
+
+    try:
+        deadline = time.monotonic() + timeout
+        # the file could have been closed before the watch was added
+        if complete():
+            return
+        while True:
+            check_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError('Timed out waiting for %s' % filename)
+            readable, _, _ = select.select([fd], [], [], min(remaining, 0.5))
+            if readable and name in _inotify_names(fd) and complete():
+                return
+    finally:
+        os.close(fd)
+
+
+def file_digest(filename):
+    """Return the sha256 hex digest of the content of filename"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# ioctl sharing the extents of a file with another one, on btrfs, xfs...
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dst):
+    """Create dst with the content of src, sharing its storage when possible:
+    a hard link, else a reflink where the filesystem supports them (a copy
+    on write clone), else a plain copy"""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        # e.g. another filesystem or no hard links
+        pass
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+ARCHIVE_FORMATS = ('deflate', 'store', 'parallel-deflate', 'zstd')
+
+
+def archive_extension(format):
+    return '.tar.zst' if format == 'zstd' else '.zip'
+
+
+def _dos_date_time(mtime):
+    t = time.localtime(max(mtime, 315532800))
+    return (((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+
+@traced('deflate')
+def _deflate_member(filename, level):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    # raw deflate stream, as stored in zip members
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    return zlib.crc32(data), len(data), compressed, os.path.getmtime(filename)
+
+
+class _DeflatedZipWriter():
+    """Minimal zip writer for members deflated beforehand, zipfile can only
+    compress members itself one at a time"""
+
+    def __init__(self, f):
+        self.f = f
+        self.entries = []
+
+    def write(self, arcname, crc, size, compressed, mtime):
+        name = arcname.encode('utf-8')
+        offset = self.f.tell()
+        if offset + len(compressed) > 0xffffffff or size > 0xffffffff:
+            raise RuntimeError('%s is too large for a zip without zip64' % arcname)
+        date, dostime = _dos_date_time(mtime)
+        # flag 0x800: utf-8 names, method 8: deflate
+        self.f.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x800, 8,
+                                 dostime, date, crc, len(compressed), size,
+                                 len(name), 0))
+        self.f.write(name)
+        self.f.write(compressed)
+        self.entries.append((name, crc, size, len(compressed), date, dostime, offset))
+
+    def close(self):
+        start = self.f.tell()
+        for name, crc, size, csize, date, dostime, offset in self.entries:
+            self.f.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 0x314, 20,
+                                     0x800, 8, dostime, date, crc, csize, size,
+                                     len(name), 0, 0, 0, 0, 0o644 << 16, offset))
+            self.f.write(name)
+        end = self.f.tell()
+        if len(self.entries) > 0xffff:
+            raise RuntimeError('Too many members for a zip without zip64')
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries),
+                                 len(self.entries), end - start, start, 0))
+
+
+class StreamingArchive():
+    """Archive whose members are compressed while they are still being
+    produced.
+
+    Files passed to add() are compressed by a background thread, in the
+    order they were added, while the caller carries on. The archive is
+    written under a temporary name next to archive_file and atomically
+    renamed by close(). format is one of ARCHIVE_FORMATS: a deflated or
+    stored zip, a zip whose members are deflated concurrently by a thread
+    pool, or a zstd compressed tar (needs the zstandard module).
+    """
+
+    def __init__(self, archive_file, format='deflate', level=None):
+        if format not in ARCHIVE_FORMATS:
+            raise ValueError('Unknown archive format %s' % format)
+        if format == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd archives need the zstandard module')
+
+        self.archive_file = archive_file
+        self.format = format
+        self.level = level
+        self.temp_file = archive_file + '.part'
+        self.pending = queue.Queue()
+        self.error = None
+        self.deflaters = None
+        if format == 'parallel-deflate':
+            self.deflaters = ThreadPoolExecutor(max_workers=os.cpu_count())
+        self.writer = threading.Thread(target=self._write)
+        self.writer.start()
+
+    def add(self, filename, arcname=None):
+        if arcname is None:
+            arcname = os.path.basename(filename)
+        if self.deflaters is not None:
+            level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+            self.pending.put((arcname, self.deflaters.submit(_deflate_member, filename, level)))
+        else:
+            self.pending.put((arcname, filename))
+
+    def _members(self):
+        while True:
+            member = self.pending.get()
+            if member is None:
+                return
+            yield member
+
+    def _write(self):
+        try:
+            with open(self.temp_file, 'wb') as f:
+                if self.format == 'zstd':
+                    level = 3 if self.level is None else self.level
+                    compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+                    with compressor.stream_writer(f, closefd=False) as stream:
+                        with tarfile.open(fileobj=stream, mode='w|') as tar:
+                            for arcname, filename in self._members():
+                                with trace_span('compress', target=arcname):
+                                    tar.add(filename, arcname)
+                elif self.format == 'parallel-deflate':
+                    archive = _DeflatedZipWriter(f)
+                    for arcname, deflated in self._members():
+                        with trace_span('write', target=arcname):
+                            archive.write(arcname, *deflated.result())
+                    archive.close()
+                else:
+                    method = zipfile.ZIP_STORED if self.format == 'store' else zipfile.ZIP_DEFLATED
+                    with zipfile.ZipFile(f, 'w', method, compresslevel=self.level) as archive:
+                        for arcname, filename in self._members():
+                            with trace_span('compress', target=arcname):
+                                archive.write(filename, arcname)
+        except BaseException as e:
+            self.error = e
+            # keep draining so that add() and close() never block
+            for member in self._members():
+                pass
+
+    def close(self):
+        """Wait for the pending members and move the archive in place"""
+        self.pending.put(None)
+        with trace_span('finish archive', target=os.path.basename(self.archive_file)):
+            self.writer.join()
+        if self.deflaters is not None:
+            self.deflaters.shutdown()
+        if self.error is not None:
+            self.abort()
+            raise self.error
+        os.replace(self.temp_file, self.archive_file)
+
+    def abort(self):
+        if self.writer.is_alive():
+            self.pending.put(None)
+            self.writer.join()
+        if self.deflaters is not None:
+            self.deflaters.shutdown(cancel_futures=True)
+        if os.path.exists(self.temp_file):
+            os.remove(self.temp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type:
+            self.abort()
+        else:
+            self.close()